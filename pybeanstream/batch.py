@@ -0,0 +1,287 @@
+# batch.py
+# This file is part of PyBeanstream.
+#
+# Copyright(c) 2011 Benoit Clennett-Sirois. All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301  USA
+
+import json
+import sys
+from array import array
+from decimal import Decimal
+
+from pybeanstream.client import API_RESPONSE_BOOLEAN_FIELDS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    array('q')
+    INT_TYPECODE = 'q'
+except ValueError:
+    # Python 2: 'l' is 64 bits on the platforms we care about.
+    INT_TYPECODE = 'l'
+
+# Columns stored as integers. Amounts are stored in cents.
+INT_COLUMNS = ('trnId', 'trnAmount')
+
+# Columns stored as 0/1 bytes.
+BOOL_COLUMNS = tuple(API_RESPONSE_BOOLEAN_FIELDS)
+
+# Columns with few distinct values, stored as codes into a list of
+# categories.
+CATEGORICAL_COLUMNS = ('cardType', 'messageId', 'avsId', 'trnType')
+
+FILE_FORMAT_VERSION = 1
+
+
+def amount_to_cents(amount):
+    """Converts an amount string such as '10.5' to 1050, or '-1.50'
+    to -150. Fractions of a cent are dropped.
+    """
+    if not amount:
+        return 0
+    return int(Decimal(amount).scaleb(2))
+
+
+class Categorical(object):
+    """Dictionary encoded column."""
+    def __init__(self, categories=None):
+        self.categories = []
+        self.index = {}
+        self.codes = array('H')
+        for value in categories or []:
+            self.encode(value)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.categories[self.codes[i]]
+
+    def encode(self, value):
+        try:
+            return self.index[value]
+        except KeyError:
+            code = self.index[value] = len(self.categories)
+            self.categories.append(value)
+            return code
+
+    def append(self, value):
+        self.codes.append(self.encode(value))
+
+    def counts(self, rows=None):
+        """Returns the number of rows for each category."""
+        n = [0] * len(self.categories)
+        codes = self.codes
+        if rows is None:
+            for c in codes:
+                n[c] += 1
+        else:
+            for i in rows:
+                n[codes[i]] += 1
+        return dict((v, n[c]) for c, v in enumerate(self.categories) if n[c])
+
+
+class BatchResults(object):
+    """Column oriented store for the responses of a batch run.
+
+    Only the columns useful for reporting are kept: integer ids and
+    amounts, booleans and dictionary encoded categoricals. Each takes
+    a few bytes per row instead of a dictionary of strings.
+
+    Filters return rows as an array of indices, which can be passed
+    to the aggregation methods.
+    """
+    def __init__(self):
+        self.columns = {}
+        for name in INT_COLUMNS:
+            self.columns[name] = array(INT_TYPECODE)
+        for name in BOOL_COLUMNS:
+            self.columns[name] = array('b')
+        for name in CATEGORICAL_COLUMNS:
+            self.columns[name] = Categorical()
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, response):
+        """Appends a BeanResponse, or its data dictionary."""
+        data = getattr(response, 'data', response)
+        c = self.columns
+        c['trnId'].append(int(data.get('trnId') or 0))
+        c['trnAmount'].append(amount_to_cents(data.get('trnAmount')))
+        for name in BOOL_COLUMNS:
+            c[name].append(1 if data.get(name) else 0)
+        for name in CATEGORICAL_COLUMNS:
+            c[name].append(data.get(name))
+        self.length += 1
+
+    def extend(self, responses):
+        for r in responses:
+            self.append(r)
+
+    def column(self, name):
+        return self.columns[name]
+
+    def _condition(self, name, value):
+        # Returns the array holding column 'name' and the value stored
+        # for 'value', or None if no row can match.
+        col = self.columns[name]
+        if isinstance(col, Categorical):
+            if value not in col.index:
+                return None
+            return col.codes, col.index[value]
+        if name == 'trnAmount':
+            return col, amount_to_cents(value)
+        if name in BOOL_COLUMNS:
+            return col, 1 if value else 0
+        return col, value
+
+    def where(self, rows=None, **conditions):
+        """Returns the indices of the rows matching every condition,
+        eg: where(cardType='VI', trnApproved=True). Pass 'rows' to
+        narrow down a previous selection.
+
+        Columns are compared as whole NumPy arrays when NumPy is
+        installed. Otherwise rows are tested one by one, which is
+        fine for a few hundred thousand rows.
+        """
+        matches = []
+        for name, value in conditions.items():
+            match = self._condition(name, value)
+            if match is None:
+                return array(INT_TYPECODE)
+            matches.append(match)
+        if numpy is not None and self.length:
+            return self._where_numpy(rows, matches)
+        if rows is None:
+            rows = range(self.length)
+        for col, value in matches:
+            rows = [i for i in rows if col[i] == value]
+        return array(INT_TYPECODE, rows)
+
+    def _where_numpy(self, rows, matches):
+        mask = numpy.ones(self.length, dtype=bool)
+        for col, value in matches:
+            mask &= numpy.frombuffer(col, numpy.dtype(col.typecode)) == value
+        if rows is None:
+            found = numpy.flatnonzero(mask)
+        else:
+            rows = numpy.asarray(rows, dtype=numpy.int64)
+            found = rows[mask[rows]]
+        return array(INT_TYPECODE, found.tolist())
+
+    def count(self, rows=None):
+        if rows is None:
+            return self.length
+        return len(rows)
+
+    def total_amount(self, rows=None):
+        """Returns the sum of 'trnAmount' as a Decimal."""
+        amounts = self.columns['trnAmount']
+        if rows is None:
+            cents = sum(amounts)
+        else:
+            cents = sum(amounts[i] for i in rows)
+        return Decimal(cents).scaleb(-2)
+
+    def count_by(self, name, rows=None):
+        """Returns the number of rows for each value of a column."""
+        col = self.columns[name]
+        if isinstance(col, Categorical):
+            return col.counts(rows)
+        counts = {}
+        for i in (range(self.length) if rows is None else rows):
+            counts[col[i]] = counts.get(col[i], 0) + 1
+        return counts
+
+    def approval_rate(self, by=None, rows=None):
+        """Returns the share of approved transactions, or a
+        dictionary of rates for each value of column 'by'.
+        """
+        approved = self.where(rows, trnApproved=True)
+        if by is None:
+            total = self.count(rows)
+            return float(len(approved)) / total if total else 0.0
+        totals = self.count_by(by, rows)
+        hits = self.count_by(by, approved)
+        return dict((k, float(hits.get(k, 0)) / n)
+                    for k, n in totals.items())
+
+    def to_numpy(self):
+        """Returns a dictionary of NumPy arrays sharing memory with the
+        columns. Categoricals are returned as a (codes, categories)
+        tuple. Requires NumPy.
+        """
+        if numpy is None:
+            raise ImportError("NumPy is required for to_numpy().")
+        arrays = {}
+        for name, col in self.columns.items():
+            if isinstance(col, Categorical):
+                arrays[name] = (numpy.frombuffer(col.codes, numpy.uint16),
+                                list(col.categories))
+            else:
+                arrays[name] = numpy.frombuffer(
+                    col, numpy.dtype(col.typecode))
+        return arrays
+
+    def save(self, path):
+        """Writes the columns to 'path': a JSON header line followed by
+        the raw arrays.
+        """
+        names = sorted(self.columns)
+        header = {
+            'version': FILE_FORMAT_VERSION,
+            'byteorder': sys.byteorder,
+            'length': self.length,
+            'columns': names,
+            'categories': dict(
+                (n, c.categories) for n, c in self.columns.items()
+                if isinstance(c, Categorical)),
+            }
+        with open(path, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            for name in names:
+                col = self.columns[name]
+                if isinstance(col, Categorical):
+                    col = col.codes
+                col.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        results = cls()
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline().decode('utf-8'))
+            if header['version'] != FILE_FORMAT_VERSION:
+                raise ValueError(
+                    "Unsupported batch file version: %s" % header['version'])
+            n = header['length']
+            for name in header['columns']:
+                if name in header['categories']:
+                    col = Categorical(header['categories'][name])
+                    results.columns[name] = col
+                    col = col.codes
+                else:
+                    col = results.columns[name]
+                col.fromfile(f, n)
+                if header['byteorder'] != sys.byteorder:
+                    col.byteswap()
+        results.length = n
+        return results
@@ -0,0 +1,337 @@
+# benchmark.py
+# This file is part of PyBeanstream.
+#
+# Copyright(c) 2011 Benoit Clennett-Sirois. All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301  USA
+
+"""Compares the SOAP API with the name/value transport.
+
+Both go through BeanClient.process_transaction() against a local
+server answering like Beanstream, so the sequential numbers only
+measure the client side: building, sending and parsing the request.
+The concurrent runs share one client between threads, with the server
+taking 'delay' seconds per transaction like Beanstream would. Run
+with:
+
+    python -m pybeanstream.benchmark [-n CALLS] [-t THREADS] [-d DELAY]
+"""
+
+from __future__ import print_function
+
+import argparse
+import threading
+import time
+from xml.sax.saxutils import escape
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlencode
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import urlencode
+
+from pybeanstream.client import BeanClient
+from pybeanstream.transports import NameValueTransport
+
+DEFAULT_CALLS = 200
+DEFAULT_THREADS = 8
+# Seconds the server takes to answer in the concurrent runs.
+DEFAULT_DELAY = 0.02
+
+SOAP_PATH = '/WebService/ProcessTransaction.asmx'
+NAME_VALUE_PATH = '/scripts/process_transaction.asp'
+
+# Same fields as an approved purchase from Beanstream.
+RESPONSE_FIELDS = [
+    ('trnApproved', '1'),
+    ('trnId', '10000800'),
+    ('messageId', '1'),
+    ('messageText', 'Approved'),
+    ('trnOrderNumber', '138889'),
+    ('authCode', 'TEST'),
+    ('errorType', 'N'),
+    ('errorFields', ''),
+    ('responseType', 'T'),
+    ('trnAmount', '10.00'),
+    ('trnDate', '3/17/2014 6:37:50 PM'),
+    ('avsProcessed', '0'),
+    ('avsId', '0'),
+    ('avsResult', '0'),
+    ('avsAddrMatch', '0'),
+    ('avsPostalMatch', '0'),
+    ('cvdId', '1'),
+    ('cardType', 'VI'),
+    ('trnType', 'P'),
+    ('paymentMethod', 'CC'),
+    ]
+
+TRANSACTION = {
+    'trnType': 'P',
+    'trnCardOwner': 'John Doe',
+    'trnCardNumber': '4030000010001234',
+    'trnCardCvd': '123',
+    'trnExpMonth': '05',
+    'trnExpYear': '15',
+    'trnOrderNumber': '138889',
+    'trnAmount': '10.00',
+    'ordEmailAddress': 'john.doe@pranana.com',
+    'ordName': 'John Doe',
+    'ordPhoneNumber': '5145555555',
+    'ordAddress1': '88 Mont-Royal Est',
+    'ordAddress2': ' ',
+    'ordCity': 'Montreal',
+    'ordProvince': 'QC',
+    'ordPostalCode': 'H2T1N6',
+    'ordCountry': 'CA',
+    'termURL': ' ',
+    'vbvEnabled': '0',
+    'scEnabled': '0',
+    'trnLanguage': 'ENG',
+    }
+
+WSDL = """<?xml version="1.0" encoding="utf-8"?>
+<wsdl:definitions
+    xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/"
+    xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+    xmlns:s="http://www.w3.org/2001/XMLSchema"
+    xmlns:tns="http://www.beanstream.com/WebService/"
+    targetNamespace="http://www.beanstream.com/WebService/">
+  <wsdl:types>
+    <s:schema elementFormDefault="qualified"
+              targetNamespace="http://www.beanstream.com/WebService/">
+      <s:element name="TransactionProcess">
+        <s:complexType><s:sequence>
+          <s:element minOccurs="0" name="inputTransaction" type="s:string"/>
+        </s:sequence></s:complexType>
+      </s:element>
+      <s:element name="TransactionProcessResponse">
+        <s:complexType><s:sequence>
+          <s:element minOccurs="0" name="TransactionProcessResult"
+                     type="s:string"/>
+        </s:sequence></s:complexType>
+      </s:element>
+    </s:schema>
+  </wsdl:types>
+  <wsdl:message name="TransactionProcessSoapIn">
+    <wsdl:part name="parameters" element="tns:TransactionProcess"/>
+  </wsdl:message>
+  <wsdl:message name="TransactionProcessSoapOut">
+    <wsdl:part name="parameters" element="tns:TransactionProcessResponse"/>
+  </wsdl:message>
+  <wsdl:portType name="ProcessTransactionSoap">
+    <wsdl:operation name="TransactionProcess">
+      <wsdl:input message="tns:TransactionProcessSoapIn"/>
+      <wsdl:output message="tns:TransactionProcessSoapOut"/>
+    </wsdl:operation>
+  </wsdl:portType>
+  <wsdl:binding name="ProcessTransactionSoap"
+                type="tns:ProcessTransactionSoap">
+    <soap:binding transport="http://schemas.xmlsoap.org/soap/http"/>
+    <wsdl:operation name="TransactionProcess">
+      <soap:operation style="document" soapAction=
+          "http://www.beanstream.com/WebService/TransactionProcess"/>
+      <wsdl:input><soap:body use="literal"/></wsdl:input>
+      <wsdl:output><soap:body use="literal"/></wsdl:output>
+    </wsdl:operation>
+  </wsdl:binding>
+  <wsdl:service name="ProcessTransaction">
+    <wsdl:port name="ProcessTransactionSoap"
+               binding="tns:ProcessTransactionSoap">
+      <soap:address location="%s"/>
+    </wsdl:port>
+  </wsdl:service>
+</wsdl:definitions>
+"""
+
+SOAP_RESPONSE = """<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <soap:Body>
+    <TransactionProcessResponse
+        xmlns="http://www.beanstream.com/WebService/">
+      <TransactionProcessResult>%s</TransactionProcessResult>
+    </TransactionProcessResponse>
+  </soap:Body>
+</soap:Envelope>
+"""
+
+
+def response_xml():
+    return '<response>%s</response>' % ''.join(
+        '<%s>%s</%s>' % (k, escape(v), k) for k, v in RESPONSE_FIELDS)
+
+
+class BeanstreamHandler(BaseHTTPRequestHandler):
+    """Answers the WSDL, SOAP and name/value requests."""
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately: without this, kept alive
+    # connections wait for delayed ACKs.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def reply(self, content, content_type):
+        content = content.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        location = 'http://%s:%d%s' % (
+            self.server.server_address + (SOAP_PATH,))
+        self.reply(WSDL % location, 'text/xml; charset=utf-8')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.count('request_bytes', len(body))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.path.startswith(SOAP_PATH):
+            self.reply(SOAP_RESPONSE % escape(response_xml()),
+                       'text/xml; charset=utf-8')
+        else:
+            self.reply(urlencode(RESPONSE_FIELDS), 'text/html')
+
+    def log_message(self, *a):
+        pass
+
+
+class BeanstreamServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), BeanstreamHandler)
+        self.delay = 0
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        with self.lock:
+            counters, self.counters = self.counters, {}
+        return counters
+
+    def url(self, path):
+        return 'http://%s:%d%s' % (self.server_address + (path,))
+
+
+def measure(client, calls, threads=1):
+    """Sends 'calls' transactions from 'threads' threads, after a warm
+    up one. Returns the seconds taken by each call and by all of them.
+    """
+    client.process_transaction('TransactionProcess', TRANSACTION)
+    times = []
+    errors = []
+
+    def send(n):
+        try:
+            for i in range(n):
+                start = time.time()
+                r = client.process_transaction('TransactionProcess',
+                                               TRANSACTION)
+                times.append(time.time() - start)
+                assert r['trnApproved'] == ['1'], r
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=send,
+                                args=(calls // threads +
+                                      (1 if i < calls % threads else 0),))
+               for i in range(threads)]
+    start = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    if errors:
+        raise errors[0]
+    return times, time.time() - start
+
+
+def summary(times, elapsed, counters):
+    # 'counters' include the warm up call.
+    times = sorted(times)
+    n = len(times)
+    return {
+        'calls': n,
+        'mean_ms': 1000 * sum(times) / n,
+        'p50_ms': 1000 * times[n // 2],
+        'p95_ms': 1000 * times[min(n - 1, int(n * 0.95))],
+        'calls_per_s': n / elapsed,
+        'request_bytes': counters.get('request_bytes', 0) // (n + 1),
+        'connections': counters.get('connections', 0),
+        }
+
+
+def run(calls=DEFAULT_CALLS, threads=DEFAULT_THREADS, delay=DEFAULT_DELAY):
+    """Returns the summary of 'calls' transactions for each API, sent
+    one after the other, then from 'threads' threads against a server
+    taking 'delay' seconds to answer.
+    """
+    server = BeanstreamServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    transport = NameValueTransport(server.url(NAME_VALUE_PATH))
+    try:
+        soap = BeanClient('user', 'password', 'merchant',
+                          wsdl_url=server.url(SOAP_PATH + '?WSDL'))
+        name_value = BeanClient('user', 'password', 'merchant',
+                                transport=transport)
+        server.reset()
+        results = {}
+        for suffix, n in (('', 1), ('_concurrent', threads)):
+            server.delay = delay if n > 1 else 0
+            for name, client in (('soap', soap), ('name_value', name_value)):
+                times, elapsed = measure(client, calls, n)
+                results[name + suffix] = summary(
+                    times, elapsed, server.reset())
+        return results
+    finally:
+        transport.close()
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--calls', type=int, default=DEFAULT_CALLS)
+    parser.add_argument('-t', '--threads', type=int,
+                        default=DEFAULT_THREADS)
+    parser.add_argument('-d', '--delay', type=float, default=DEFAULT_DELAY)
+    args = parser.parse_args()
+    results = run(args.calls, args.threads, args.delay)
+    columns = ('calls', 'mean_ms', 'p50_ms', 'p95_ms', 'calls_per_s',
+               'request_bytes', 'connections')
+    print('%-22s' % 'api' + ''.join('%14s' % c for c in columns))
+    for name in ('soap', 'name_value', 'soap_concurrent',
+                 'name_value_concurrent'):
+        print('%-22s' % name + ''.join(
+            ('%14.3f' if isinstance(results[name][c], float) else '%14d')
+            % results[name][c] for c in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+# bins.py
+# This file is part of PyBeanstream.
+#
+# Copyright(c) 2011 Benoit Clennett-Sirois. All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301  USA
+
+import os
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from heapq import heappop, heappush
+
+from pybeanstream.client import BeanUserError
+
+# Number of leading digits the ranges are compared on.
+PREFIX_DIGITS = 8
+
+BIN_RANGES_FILE = os.path.join(os.path.dirname(__file__), 'bin_ranges.csv')
+
+CardBrand = namedtuple('CardBrand', 'brand lengths cvd_length')
+
+
+def card_prefix(card_number):
+    """Returns the first PREFIX_DIGITS digits of a card number as an
+    integer, or None if it isn't made of digits.
+    """
+    if type(card_number) == bytes:
+        card_number = card_number.decode('ascii', 'ignore')
+    prefix = card_number[:PREFIX_DIGITS]
+    if not prefix.isdigit():
+        return None
+    return int(prefix.ljust(PREFIX_DIGITS, '0'))
+
+
+class BinIndex(object):
+    """Maps card number prefixes to a CardBrand.
+
+    Ranges are flattened to non overlapping intervals when the index
+    is built, in O(n log n), so a lookup is a single bisect in a sorted
+    array.
+    """
+    def __init__(self, ranges):
+        """'ranges' is an iterable of (low, high, CardBrand) tuples,
+        'low' and 'high' being inclusive prefixes as strings.
+        """
+        spans = []
+        for low, high, brand in ranges:
+            spans.append((int(low.ljust(PREFIX_DIGITS, '0')),
+                          int(high.ljust(PREFIX_DIGITS, '9')),
+                          brand))
+
+        bounds = set()
+        for low, high, brand in spans:
+            bounds.add(low)
+            bounds.add(high + 1)
+        bounds = sorted(bounds)
+
+        # Sweep the intervals between bounds, keeping the ranges open
+        # at each one in a heap ordered by width, then by file order.
+        # No bound falls inside an interval, so a range that started
+        # before it and isn't over yet covers all of it.
+        by_low = sorted(range(len(spans)), key=lambda i: spans[i][0])
+        opened = []
+        n = 0
+
+        self.starts = array('l')
+        self.ends = array('l')
+        self.brands = []
+        for start, stop in zip(bounds, bounds[1:]):
+            while n < len(by_low) and spans[by_low[n]][0] <= start:
+                low, high, brand = spans[by_low[n]]
+                heappush(opened, (high - low, by_low[n], high, brand))
+                n += 1
+            while opened and opened[0][2] < start:
+                heappop(opened)
+            if not opened:
+                continue
+            # The narrowest range covering this interval wins.
+            brand = opened[0][3]
+            if self.brands and self.brands[-1] is brand and \
+                    self.ends[-1] == start - 1:
+                self.ends[-1] = stop - 1
+            else:
+                self.starts.append(start)
+                self.ends.append(stop - 1)
+                self.brands.append(brand)
+
+    @classmethod
+    def from_file(cls, path=BIN_RANGES_FILE):
+        """Loads ranges from a 'low,high,brand,lengths,cvd_length' file.
+        See bin_ranges.csv for the format.
+        """
+        ranges = []
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                low, high, brand, lengths, cvd_length = line.split(',')
+                ranges.append((low, high, CardBrand(
+                    brand,
+                    tuple(int(l) for l in lengths.split('|')),
+                    int(cvd_length))))
+        return cls(ranges)
+
+    def __len__(self):
+        return len(self.brands)
+
+    def lookup(self, card_number):
+        """Returns the CardBrand of a card number, or None."""
+        key = card_prefix(card_number)
+        if key is None:
+            return None
+        i = bisect_right(self.starts, key) - 1
+        if i >= 0 and key <= self.ends[i]:
+            return self.brands[i]
+        return None
+
+    def lookup_many(self, card_numbers):
+        return [self.lookup(n) for n in card_numbers]
+
+    def brand(self, card_number):
+        """Returns the Beanstream cardType code of a card number."""
+        entry = self.lookup(card_number)
+        return entry.brand if entry else None
+
+    def validate(self, card_number, cvd=None, supported=None):
+        """Checks the card number length and CVD length against the
+        brand and returns its CardBrand. 'supported' optionally lists
+        the accepted cardType codes.
+        Raises a BeanUserError, like the API would, if the data is not
+        valid.
+        """
+        entry = self.lookup(card_number)
+        if entry is None:
+            raise BeanUserError('trnCardNumber', 'Unknown card brand')
+        if supported is not None and entry.brand not in supported:
+            raise BeanUserError('trnCardNumber', 'Unsupported card brand')
+        if len(card_number) not in entry.lengths:
+            raise BeanUserError('trnCardNumber', 'Invalid card number')
+        if cvd and len(cvd) != entry.cvd_length:
+            raise BeanUserError('trnCardCvd', 'Invalid card CVD')
+        return entry
+
+    def route(self, card_number, routes, default=None):
+        """Picks a value, eg: a BeanClient for a merchant account, from
+        the 'routes' dictionary keyed by cardType code.
+        """
+        return routes.get(self.brand(card_number), default)
+
+
+_default_index = None
+
+
+def default_index():
+    """Returns the index of the bundled bin_ranges.csv file."""
+    global _default_index
+    if _default_index is None:
+        _default_index = BinIndex.from_file()
+    return _default_index
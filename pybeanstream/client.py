@@ -19,11 +19,24 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301  USA
 
+import copy
+import logging
+import time
 import unicodedata
-from suds.client import Client
+from suds.client import Client, ServiceSelector
+from suds.options import Options
+from suds.properties import Unskin
 from xml.etree.ElementTree import Element, tostring
+from pybeanstream import forking
+from pybeanstream.endpoints import EndpointPool
 from pybeanstream.xml_utils import xmltodict
 
+try:
+    from urllib.error import URLError
+except ImportError:
+    from urllib2 import URLError
+
+log = logging.getLogger(__name__)
 
 WSDL_NAME = 'ProcessTransaction.wsdl'
 WSDL_LOCAL_PREFIX = 'BeanStream'
@@ -71,6 +84,44 @@ SIZE_LIMITS = {
     'trnLanguage': 3,
 }
 
+# Suds clients built by preload(), by WSDL url.
+PRELOADED_CLIENTS = {}
+
+
+def preload(wsdl_url=WSDL_URL, freeze=True):
+    """Parses the WSDL once, eg: in a pre-fork server's master process.
+    BeanClient instances created afterwards, including in forked
+    workers, clone the parsed client instead of loading the WSDL again,
+    and share its memory with the master. 'wsdl_url' can be a list.
+
+    With 'freeze', the garbage collector is told to leave the loaded
+    objects alone (Python 3.7+), so workers don't copy their pages.
+    """
+    if not isinstance(wsdl_url, (list, tuple)):
+        wsdl_url = [wsdl_url]
+    for url in wsdl_url:
+        if url not in PRELOADED_CLIENTS:
+            PRELOADED_CLIENTS[url] = Client(url)
+    # The response parser imports its XML builder on first use.
+    xmltodict('<response><trnApproved>0</trnApproved></response>')
+    if freeze:
+        forking.freeze()
+
+
+def clone_client(client):
+    """Returns a suds client sharing the parsed WSDL of 'client' but
+    with its own copy of the options. Does what Client.clone() does,
+    which recurses forever under Python 3 when deep copying the linked
+    options object, by copying only the option values.
+    """
+    clone = copy.copy(client)
+    clone.options = Options()
+    Unskin(clone.options).update(
+        copy.deepcopy(Unskin(client.options).defined))
+    clone.service = ServiceSelector(clone, client.wsdl.services)
+    clone.messages = dict(tx=None, rx=None)
+    return clone
+
 
 class BaseBeanClientException(Exception):
     """Exception Raised By the BeanClient"""
@@ -103,6 +154,12 @@ class BeanSystemError(BaseBeanClientException):
         super(BeanSystemError, self).__init__(e)
 
 
+class BeanResponseError(BeanSystemError):
+    """Raised when a response has no error type, so it doesn't tell
+    whether the transaction went through.
+    """
+
+
 class BeanResponse(object):
     def __init__(self, r, trans_type):
         # Turn dictionary values as object attributes.
@@ -131,21 +188,55 @@ class BeanClient(object):
                  service_version="1.3",
                  storage='/tmp',
                  fix_string_size=True,
-                 wsdl_url=WSDL_URL):
+                 wsdl_url=WSDL_URL,
+                 probe_interval=None,
+                 transport=None,
+                 retry_policy=None,
+                 ledger=None):
         """
         'fix_string_size' parameter will automatically fix each string
         size to the documented length to avoid problems. If set to
         False, it will send the data regardless of string size.
+
+        'wsdl_url' can also be an ordered list of WSDL urls. Calls then
+        go to the healthiest endpoint (the WSDL url without its query)
+        and fail over to the next one when it can't be reached. An
+        endpoint's error rate decays with time, so one that was down
+        gets traffic again after a while. Set 'probe_interval' to a
+        number of seconds to also probe the endpoints in the
+        background.
+
+        'transport' replaces the SOAP API, eg: a NameValueTransport
+        from pybeanstream.transports. The WSDL is not loaded then.
+
+        'retry_policy' is a pybeanstream.retry.RetryPolicy. By default,
+        each transaction is attempted once.
+
+        'ledger' is a pybeanstream.ledger.Ledger recording every
+        response, which allows refunds and voids by order number.
         """
 
         # Settings config attributes
         self.fix_string_size = fix_string_size
+        self.transport = transport
+        self.retry_policy = retry_policy
+        self.ledger = ledger
+
+        if isinstance(wsdl_url, (list, tuple)):
+            urls = wsdl_url
+        else:
+            urls = [wsdl_url]
+        self.endpoints = EndpointPool(urls)
+        self._endpoint_clients = {}
 
         # Instantiate suds client objects.
-        self.suds_client = Client(wsdl_url)
-        self.suds_client.set_options(headers={
-            'Content-Type': 'text/xml; charset=utf-8'
-            })
+        if transport is None:
+            self.suds_client = self.load_wsdl()
+            self.suds_client.set_options(headers={
+                'Content-Type': 'text/xml; charset=utf-8'
+                })
+        else:
+            self.suds_client = None
         self.auth_data = {
             'username': username,
             'password': password,
@@ -153,43 +244,124 @@ class BeanClient(object):
             'serviceVersion': service_version,
             }
 
-    def process_transaction(self, service, data):
-        """ Transforms data to a xml request, calls remote service
-        with supplied data, processes errors and returns an dictionary
-        with response data.
+        if probe_interval:
+            self.endpoints.start_probes(probe_interval)
+
+    def warm_up(self):
+        """Opens connections ahead of the first transaction, eg: right
+        after a worker is forked. With the SOAP API, this probes the
+        endpoints once, which also resolves their names.
         """
+        if self.transport is not None:
+            self.transport.connect()
+        else:
+            self.endpoints.probe()
 
-        # Create XML tree
+    def load_wsdl(self):
+        """Builds the suds client from the first endpoint whose WSDL
+        can be loaded.
+        """
+        error = None
+        for endpoint in self.endpoints.ordered():
+            if endpoint.url in PRELOADED_CLIENTS:
+                return clone_client(PRELOADED_CLIENTS[endpoint.url])
+            try:
+                return Client(endpoint.url)
+            except URLError as e:
+                endpoint.record_failure()
+                error = e
+        raise error
+
+    def endpoint_stats(self):
+        """Returns latency and error rate of each endpoint."""
+        return self.endpoints.stats()
+
+    def endpoint_client(self, endpoint):
+        """Returns the suds client sending to 'endpoint'. With several
+        endpoints, each one gets its own clone of the client, so calls
+        in other threads never change where a request goes.
+        """
+        if len(self.endpoints) == 1:
+            return self.suds_client
+        client = self._endpoint_clients.get(endpoint.url)
+        if client is None:
+            client = clone_client(self.suds_client)
+            client.set_options(location=endpoint.location)
+            self._endpoint_clients[endpoint.url] = client
+        return client
+
+    def call_service(self, service, req):
+        """Sends the request to the healthiest endpoint, failing over
+        to the next one if it can't be reached.
+        """
+        error = None
+        for endpoint in self.endpoints.ordered():
+            client = self.endpoint_client(endpoint)
+            start = time.time()
+            try:
+                resp = getattr(client.service, service)(req)
+            except URLError as e:
+                # The connection could not be opened, so the request
+                # never reached Beanstream: safe to send it elsewhere.
+                endpoint.record_failure()
+                error = e
+            except Exception:
+                endpoint.record_failure()
+                raise
+            else:
+                endpoint.record_success(time.time() - start)
+                return resp
+        raise error
+
+    def prepare_data(self, data):
+        """Returns the (field, text) pairs to send: text values decoded,
+        transliterated to ASCII and cut to SIZE_LIMITS. Empty values
+        are left out.
+        """
         enc = 'utf-8'
-        t = Element('transaction', charset=enc)
-
+        items = []
         for k in data.keys():
             val = data[k]
+            if not val:
+                continue
+            if type(val) == bytes:
+                val = val.decode(enc)
+            # Convert accents. After discussing w/ BeanStream, it appears
+            # the API does not support accented characters.
+            val = unicodedata.normalize(
+                'NFKD', val).encode('ascii', 'ignore').decode(enc)
             # Fix data string size
             if self.fix_string_size:
                 l = SIZE_LIMITS[k]
                 if l:
                     val = val[:l]
             if val:
-                e_text = data[k]
-                if type(e_text) == bytes:
-                    e_text = e_text.decode(enc)
-                e = Element(k)
+                items.append((k, val))
+        return items
 
-                e.text = e_text
-                t.append(e)
+    def process_transaction(self, service, data):
+        """ Transforms data to a xml request, calls remote service
+        with supplied data, processes errors and returns an dictionary
+        with response data.
+        """
+        items = self.prepare_data(data)
+        if self.transport is not None:
+            return self.transport.process(items)
 
-        # Request to string:
-        req_str = tostring(t, enc).decode(enc)
+        # Create XML tree
+        enc = 'utf-8'
+        t = Element('transaction', charset=enc)
+
+        for k, val in items:
+            e = Element(k)
+            e.text = val
+            t.append(e)
 
-        # Convert accents. After discussing w/ BeanStream, it appears
-        # the API does not support accented characters.
-        req = unicodedata.normalize(
-            'NFKD', req_str).encode('ascii', 'ignore').decode(enc)
+        # Request to string:
+        req = tostring(t, enc).decode(enc)
 
         # Process transaction
-        resp = getattr(self.suds_client.service,
-                       service)(req)
+        resp = self.call_service(service, req)
 
         # Convert response
         r = xmltodict(resp)
@@ -209,13 +381,47 @@ class BeanClient(object):
             if 'errorFields' in data and 'errorMessage' in data:
                 raise BeanUserError(data['errorFields'], data['errorMessage'])
             else:
-                raise BeanSystemError(msg)
+                raise BeanResponseError(msg)
         if data['errorType'] == 'U':
             raise BeanUserError(data['errorFields'], msg)
         # Check for another error I haven't seen yet:
         elif data['errorType'] == 'S':
             raise BeanSystemError(msg)
 
+    def send_transaction(self, service, transaction_data):
+        """Processes the transaction, retrying it if the retry policy
+        allows, and returns the checked response.
+        """
+        method = transaction_data['trnType']
+
+        def attempt():
+            response = BeanResponse(
+                self.process_transaction(service, transaction_data),
+                method)
+
+            self._response = response
+
+            self.check_for_errors(response)
+
+            return response
+
+        if self.retry_policy is None:
+            response = attempt()
+        else:
+            response = self.retry_policy.run(
+                method, transaction_data['trnOrderNumber'], attempt)
+
+        if self.ledger is not None:
+            # The transaction went through: failing to record it must
+            # not hide the response from the caller.
+            try:
+                self.ledger.record(response, transaction_data.get('adjId'))
+            except Exception:
+                log.exception("Could not record transaction %s in the"
+                              " ledger", response.data.get('trnId'))
+
+        return response
+
     def purchase_base_request(self,
                               method,
                               cc_owner_name,
@@ -282,13 +488,7 @@ class BeanClient(object):
 
         transaction_data.update(self.auth_data)
 
-        response = BeanResponse(
-            self.process_transaction(service, transaction_data),
-            method)
-
-        self.check_for_errors(response)
-
-        return response
+        return self.send_transaction(service, transaction_data)
 
     def adjustment_base_request(self,
                                 method,
@@ -317,15 +517,7 @@ class BeanClient(object):
 
         transaction_data.update(self.auth_data)
 
-        response = BeanResponse(
-            self.process_transaction(service, transaction_data),
-            method)
-
-        self._response = response
-
-        self.check_for_errors(response)
-
-        return response
+        return self.send_transaction(service, transaction_data)
 
     def purchase_request(self, *a, **kw):
         """Call this to create a Purchase. SecureCode / VerifiedByVisa
@@ -364,3 +556,29 @@ class BeanClient(object):
         """
         method = 'V'
         return self.adjustment_base_request(method, *a, **kw)
+
+    def refund_by_order(self, amount, order_num, trn_language=DEFAULT_LANG):
+        """Refunds an order recorded in the ledger. Refunds over the
+        remaining balance are rejected locally with a BeanUserError.
+        """
+        original = self.ledger.original(order_num)
+        trn_id = original['trn_id']
+        with self.ledger.adjustment_lock(trn_id):
+            self.ledger.check_refund(trn_id, amount)
+            return self.refund_request(
+                amount, order_num, str(trn_id), trn_language)
+
+    def void_by_order(self, order_num, trn_language=DEFAULT_LANG,
+                      today=None):
+        """Voids an order recorded in the ledger, for its full amount.
+        Raises a BeanUserError if it's not from today or was already
+        refunded. 'today' is the current date in Beanstream's
+        timezone, see Ledger.check_void().
+        """
+        original = self.ledger.original(order_num)
+        trn_id = original['trn_id']
+        with self.ledger.adjustment_lock(trn_id):
+            self.ledger.check_void(trn_id, today)
+            return self.void_request(
+                original['data']['trnAmount'], order_num,
+                str(trn_id), trn_language)
@@ -0,0 +1,208 @@
+# endpoints.py
+# This file is part of PyBeanstream.
+#
+# Copyright(c) 2011 Benoit Clennett-Sirois. All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301  USA
+
+import threading
+import time
+
+from pybeanstream import forking
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+# Weight given to the newest sample in the moving averages.
+DEFAULT_EWMA_ALPHA = 0.3
+
+# An endpoint whose error rate reaches this is considered unhealthy
+# and only gets traffic when every other endpoint is unhealthy too.
+DEFAULT_MAX_ERROR_RATE = 0.5
+
+# Seconds for the error rate to halve when nothing is recorded, so an
+# endpoint that stopped getting traffic after a blip comes back.
+DEFAULT_ERROR_HALF_LIFE = 30
+
+# Health probe settings, in seconds.
+DEFAULT_PROBE_INTERVAL = 30
+DEFAULT_PROBE_TIMEOUT = 10
+
+
+class Endpoint(object):
+    """Exponentially weighted latency and error rate of a single
+    Beanstream endpoint. The error rate also decays with time, halving
+    every 'error_half_life' seconds.
+    """
+    def __init__(self,
+                 url,
+                 alpha=DEFAULT_EWMA_ALPHA,
+                 max_error_rate=DEFAULT_MAX_ERROR_RATE,
+                 error_half_life=DEFAULT_ERROR_HALF_LIFE):
+        self.url = url
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.error_half_life = error_half_life
+        self.latency = None
+        self._error_rate = 0.0
+        self._updated_at = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    @property
+    def location(self):
+        """SOAP service location: the WSDL url without its query."""
+        return self.url.split('?')[0]
+
+    @property
+    def error_rate(self):
+        elapsed = max(time.time() - self._updated_at, 0.0)
+        return self._error_rate * 0.5 ** (elapsed / self.error_half_life)
+
+    @property
+    def healthy(self):
+        return self.error_rate < self.max_error_rate
+
+    def _update(self, latency, error):
+        a = self.alpha
+        with self.lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+            if latency is not None:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency = a * latency + (1 - a) * self.latency
+            error_rate = self.error_rate
+            self._error_rate = a * float(error) + (1 - a) * error_rate
+            self._updated_at = time.time()
+
+    def record_success(self, latency):
+        self._update(latency, False)
+
+    def record_failure(self):
+        # Failures are not timed: a refused connection fails fast and
+        # would make a dead endpoint look like the fastest one.
+        self._update(None, True)
+
+    def score(self):
+        """Expected time to get a successful answer from this
+        endpoint. Lower is better.
+        """
+        latency = self.latency or 0.0
+        return latency / max(1.0 - self.error_rate, 0.01)
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+            'requests': self.requests,
+            'errors': self.errors,
+            'healthy': self.healthy,
+            }
+
+
+class EndpointPool(object):
+    """Ordered set of endpoints. Calls are routed to the healthiest
+    one; on ties, the configured order wins.
+    """
+    def __init__(self,
+                 urls,
+                 alpha=DEFAULT_EWMA_ALPHA,
+                 max_error_rate=DEFAULT_MAX_ERROR_RATE,
+                 error_half_life=DEFAULT_ERROR_HALF_LIFE):
+        if not urls:
+            raise ValueError("At least one endpoint url is required.")
+        self.endpoints = [Endpoint(u, alpha, max_error_rate, error_half_life)
+                          for u in urls]
+        self._probe_thread = None
+        self._probe_stop = threading.Event()
+        self._probe_args = None
+        forking.register(self)
+
+    def after_fork(self):
+        # Threads don't survive a fork and locks may be held by one.
+        for endpoint in self.endpoints:
+            endpoint.lock = threading.Lock()
+        self._probe_thread = None
+        self._probe_stop = threading.Event()
+        if self._probe_args is not None:
+            self.start_probes(*self._probe_args)
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def ordered(self):
+        """Returns endpoints from the healthiest to the least healthy.
+        Endpoints that were never measured come after measured healthy
+        ones, so backups only get live traffic once probes vouch for
+        them or the others fail.
+        """
+        return sorted(self.endpoints,
+                      key=lambda e: (not e.healthy,
+                                     e.latency is None,
+                                     e.score()))
+
+    def best(self):
+        return self.ordered()[0]
+
+    def stats(self):
+        return [e.stats() for e in self.endpoints]
+
+    def probe(self, timeout=DEFAULT_PROBE_TIMEOUT):
+        """Fetches each endpoint's url once and records the outcome.
+        """
+        for endpoint in self.endpoints:
+            start = time.time()
+            try:
+                urlopen(endpoint.url, timeout=timeout).read()
+            except Exception:
+                endpoint.record_failure()
+            else:
+                endpoint.record_success(time.time() - start)
+
+    def _probe_loop(self, interval, timeout):
+        while not self._probe_stop.wait(interval):
+            self.probe(timeout)
+
+    def start_probes(self,
+                     interval=DEFAULT_PROBE_INTERVAL,
+                     timeout=DEFAULT_PROBE_TIMEOUT):
+        """Starts probing the endpoints every 'interval' seconds in a
+        daemon thread, so unhealthy endpoints get back in rotation
+        without waiting for live traffic.
+        """
+        if self._probe_thread is not None and self._probe_thread.is_alive():
+            return
+        self._probe_stop.clear()
+        self._probe_args = (interval, timeout)
+        self._probe_thread = threading.Thread(
+            target=self._probe_loop, args=(interval, timeout))
+        self._probe_thread.daemon = True
+        self._probe_thread.start()
+
+    def stop_probes(self):
+        self._probe_args = None
+        self._probe_stop.set()
+        if self._probe_thread is not None:
+            self._probe_thread.join()
+            self._probe_thread = None
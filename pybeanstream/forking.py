@@ -0,0 +1,56 @@
+# forking.py
+# This file is part of PyBeanstream.
+#
+# Copyright(c) 2011 Benoit Clennett-Sirois. All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301  USA
+
+"""Objects holding sockets, locks or threads register here to get their
+after_fork() method called in forked children.
+
+On Python 3.7+ this happens automatically. Otherwise, call after_fork()
+from the server's post fork hook, eg: gunicorn's post_fork.
+"""
+
+import gc
+import os
+import weakref
+
+_handlers = weakref.WeakSet()
+
+
+def register(obj):
+    """Calls obj.after_fork() in children forked after this."""
+    _handlers.add(obj)
+
+
+def after_fork():
+    for obj in list(_handlers):
+        obj.after_fork()
+
+
+def freeze():
+    """Moves every object tracked by the garbage collector to a
+    permanent generation, so collections in the children don't write
+    to the pages shared with the parent. Needs Python 3.7+.
+    """
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=after_fork)
@@ -0,0 +1,231 @@
+# ledger.py
+# This file is part of PyBeanstream.
+#
+# Copyright(c) 2011 Benoit Clennett-Sirois. All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301  USA
+
+import json
+import re
+import sqlite3
+import threading
+from datetime import date, datetime
+
+from pybeanstream import forking
+from pybeanstream.batch import amount_to_cents
+from pybeanstream.client import BeanUserError
+
+# 'trnDate' in responses, eg: 3/17/2014 6:37:50 PM. Parsed by hand
+# since strptime's %p depends on the locale.
+TRN_DATE_RE = re.compile(
+    r'^\s*(\d{1,2})/(\d{1,2})/(\d{4})\s+(\d{1,2}):(\d{2}):(\d{2})'
+    r'\s*([AaPp][Mm])?\s*$')
+
+# Transactions that can be refunded or voided.
+ORIGINAL_TYPES = ('P', 'PAC')
+
+# Adjustments reducing the refundable balance. Beanstream answers
+# voids with 'VP' or 'VR'.
+REFUND_TYPES = ('R',)
+VOID_TYPES = ('V', 'VP', 'VR')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    trn_id INTEGER PRIMARY KEY,
+    order_number TEXT,
+    trn_type TEXT NOT NULL,
+    approved INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    adj_id INTEGER,
+    trn_date TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_order
+    ON transactions (order_number);
+CREATE INDEX IF NOT EXISTS transactions_date ON transactions (trn_date);
+CREATE INDEX IF NOT EXISTS transactions_adj ON transactions (adj_id);
+"""
+
+COLUMNS = ('trn_id', 'order_number', 'trn_type', 'approved', 'amount',
+           'adj_id', 'trn_date', 'data')
+
+
+def parse_trn_date(value):
+    """Returns 'trnDate' as an ISO string, or None if it's missing or
+    can't be parsed.
+    """
+    match = TRN_DATE_RE.match(value or '')
+    if match is None:
+        return None
+    month, day, year, hour, minute, second = [
+        int(g) for g in match.groups()[:6]]
+    meridiem = (match.group(7) or '').upper()
+    if meridiem:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem == 'PM' else 0)
+    try:
+        return datetime(year, month, day, hour, minute,
+                        second).isoformat(' ')
+    except ValueError:
+        return None
+
+
+class Ledger(object):
+    """Local SQLite record of transaction responses, indexed by trnId,
+    order number, date and original transaction.
+
+    Amounts are stored in cents. Pass ':memory:' as 'path' for a
+    ledger that only lives as long as the process.
+
+    Dates are as reported by Beanstream, in its own timezone.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._adjustment_locks = {}
+        self.conn = self._connect()
+        forking.register(self)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False,
+                               isolation_level=None)
+        conn.executescript(SCHEMA)
+        return conn
+
+    def after_fork(self):
+        # SQLite connections must not be used across a fork.
+        self.lock = threading.Lock()
+        self._adjustment_locks = {}
+        if self.path != ':memory:':
+            self.conn = self._connect()
+
+    def close(self):
+        self.conn.close()
+
+    def adjustment_lock(self, trn_id):
+        """Returns the lock to hold while checking and sending an
+        adjustment of 'trn_id', so two refunds can't both pass the
+        balance check. It only covers this process.
+        """
+        with self.lock:
+            return self._adjustment_locks.setdefault(
+                int(trn_id), threading.Lock())
+
+    def _query(self, sql, args=()):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT %s FROM transactions %s" % (', '.join(COLUMNS), sql),
+                args).fetchall()
+        return [self._row(r) for r in rows]
+
+    def _row(self, row):
+        r = dict(zip(COLUMNS, row))
+        r['approved'] = bool(r['approved'])
+        r['data'] = json.loads(r['data'])
+        return r
+
+    def record(self, response, adj_id=None):
+        """Records a BeanResponse. 'adj_id' is the trnId of the original
+        transaction for adjustments.
+        """
+        data = response.data
+        if not data.get('trnId'):
+            return
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO transactions (%s)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % ', '.join(COLUMNS),
+                (int(data['trnId']),
+                 data.get('trnOrderNumber'),
+                 data.get('trnType') or '',
+                 1 if data.get('trnApproved') else 0,
+                 amount_to_cents(data.get('trnAmount')),
+                 int(adj_id) if adj_id else None,
+                 parse_trn_date(data.get('trnDate')),
+                 json.dumps(data)))
+
+    def get(self, trn_id):
+        rows = self._query("WHERE trn_id = ?", (int(trn_id),))
+        return rows[0] if rows else None
+
+    def by_order(self, order_number):
+        return self._query(
+            "WHERE order_number = ? ORDER BY trn_id", (order_number,))
+
+    def between(self, start, end):
+        """Returns transactions from 'start' to 'end', excluded. Both
+        are dates or datetimes.
+        """
+        return self._query(
+            "WHERE trn_date >= ? AND trn_date < ? ORDER BY trn_date",
+            (str(start), str(end)))
+
+    def adjustments(self, trn_id):
+        return self._query(
+            "WHERE adj_id = ? ORDER BY trn_id", (int(trn_id),))
+
+    def original(self, order_number):
+        """Returns the latest approved purchase or pre-auth completion
+        of an order. Raises a BeanUserError if there is none.
+        """
+        rows = self._query(
+            "WHERE order_number = ? AND approved = 1 AND trn_type IN (?, ?)"
+            " ORDER BY trn_id DESC LIMIT 1",
+            (order_number,) + ORIGINAL_TYPES)
+        if not rows:
+            raise BeanUserError(
+                'trnOrderNumber', 'No approved transaction for this order')
+        return rows[0]
+
+    def refundable(self, trn_id):
+        """Returns the amount, in cents, that can still be refunded."""
+        original = self.get(trn_id)
+        if original is None or not original['approved']:
+            return 0
+        balance = original['amount']
+        for adj in self.adjustments(trn_id):
+            if not adj['approved']:
+                continue
+            if adj['trn_type'] in VOID_TYPES:
+                return 0
+            if adj['trn_type'] in REFUND_TYPES:
+                balance -= adj['amount']
+        return max(balance, 0)
+
+    def check_refund(self, trn_id, amount):
+        if amount_to_cents(amount) > self.refundable(trn_id):
+            raise BeanUserError(
+                'trnAmount', 'Amount exceeds the refundable balance')
+
+    def check_void(self, trn_id, today=None):
+        """Voids are only allowed on the same day as the purchase, for
+        the full amount, and before any refund.
+
+        'trnDate' is in Beanstream's timezone, so 'today' should be the
+        current date there. It defaults to the local date, which is
+        wrong around midnight when the two timezones differ.
+        """
+        original = self.get(trn_id)
+        if original is None or not original['approved']:
+            raise BeanUserError('adjId', 'No approved transaction to void')
+        today = today or date.today()
+        if not (original['trn_date'] or '').startswith(today.isoformat()):
+            raise BeanUserError(
+                'adjId', 'Voids are only allowed on the same day')
+        if self.refundable(trn_id) != original['amount']:
+            raise BeanUserError(
+                'adjId', 'Transaction was already refunded or voided')
@@ -0,0 +1,407 @@
+# outbox.py
+# This file is part of PyBeanstream.
+#
+# Copyright(c) 2011 Benoit Clennett-Sirois. All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301  USA
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from pybeanstream import forking
+from pybeanstream.client import (
+    BaseBeanClientException, BeanResponseError, BeanSystemError,
+    BeanUserError, URLError,
+)
+
+log = logging.getLogger(__name__)
+
+# Item states.
+PENDING = 'pending'
+INFLIGHT = 'inflight'
+DONE = 'done'
+# Failed for good, eg: rejected data or too many attempts.
+DEAD = 'dead'
+# Sent, but the outcome is not known. These are never submitted
+# again automatically and have to be reconciled by hand.
+UNKNOWN = 'unknown'
+
+# BeanClient methods that can be queued.
+OUTBOX_METHODS = (
+    'purchase_request',
+    'preauth_request',
+    'complete_request',
+    'refund_request',
+    'void_request',
+    )
+
+# Positional arguments of purchase_request and preauth_request, up to
+# the token.
+PURCHASE_METHODS = ('purchase_request', 'preauth_request')
+PURCHASE_ARGS = (
+    'cc_owner_name', 'cc_num', 'cc_cvv', 'cc_exp_month', 'cc_exp_year',
+    'amount', 'order_num', 'cust_email', 'cust_name', 'cust_phone',
+    'cust_address_line1', 'cust_city', 'cust_province',
+    'cust_postal_code', 'cust_country', 'single_use_token',
+    )
+
+# Card data that must never be written to the database.
+CARD_ARGS = ('cc_num', 'cc_cvv')
+
+# Seconds a claimed item stays hidden from other workers.
+DEFAULT_VISIBILITY_TIMEOUT = 300
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_MAX_DEPTH = 10000
+# Seconds before the first retry, doubled after each attempt.
+DEFAULT_RETRY_DELAY = 5
+DEFAULT_POLL_INTERVAL = 0.5
+# Seconds over which the drain rate is measured.
+DRAIN_RATE_WINDOW = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    method TEXT NOT NULL,
+    args TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    visible_at REAL NOT NULL,
+    finished_at REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, visible_at);
+CREATE INDEX IF NOT EXISTS outbox_finished ON outbox (finished_at);
+"""
+
+
+OutboxItem = namedtuple('OutboxItem', 'id method args kwargs attempts')
+
+
+class OutboxFull(BaseBeanClientException):
+    """Raised when the outbox holds 'max_depth' unfinished items."""
+    def __init__(self, depth):
+        e = "Outbox is full: %s items waiting" % depth
+        super(OutboxFull, self).__init__(e)
+
+
+class Outbox(object):
+    """Durable SQLite queue of BeanClient calls, drained by a pool of
+    worker threads.
+
+    enqueue() returns as soon as the call is committed to disk. An
+    item is flagged as sent right before it goes to Beanstream, so
+    after a crash only items that were never sent are claimed again;
+    the others end up UNKNOWN instead of being charged twice.
+
+    Arguments are stored as JSON in the database file until the item
+    is finished, so they must be strings. Card numbers and CVDs are
+    refused: queued purchases and pre-auths must use a single use
+    token.
+    """
+    def __init__(self,
+                 path,
+                 max_depth=DEFAULT_MAX_DEPTH,
+                 visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 retry_delay=DEFAULT_RETRY_DELAY):
+        self.path = path
+        self.max_depth = max_depth
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._local = threading.local()
+        self._workers = []
+        self._stop = threading.Event()
+        self.connection().executescript(SCHEMA)
+        forking.register(self)
+
+    def after_fork(self):
+        # SQLite connections must not be used across a fork, and the
+        # workers didn't follow.
+        self._local = threading.local()
+        self._workers = []
+        self._stop = threading.Event()
+
+    def connection(self):
+        """Returns this thread's connection to the database."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Closes this thread's connection to the database."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def depth(self):
+        """Number of items waiting to be processed."""
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM outbox WHERE state IN (?, ?)",
+            (PENDING, INFLIGHT)).fetchone()[0]
+
+    def enqueue(self, method, *args, **kwargs):
+        """Queues a call to BeanClient.'method' and returns its id.
+
+        'timeout' is how long to wait for room when the outbox is
+        full before raising OutboxFull. Defaults to 0.
+        """
+        timeout = kwargs.pop('timeout', 0)
+        if method not in OUTBOX_METHODS:
+            raise ValueError("Can't queue method %s" % method)
+        if method in PURCHASE_METHODS:
+            named = dict(zip(PURCHASE_ARGS, args))
+            named.update(kwargs)
+            if (any(named.get(k) for k in CARD_ARGS) or
+                    not named.get('single_use_token')):
+                raise ValueError("Card numbers and CVDs can't be queued,"
+                                 " use a single use token.")
+        data = json.dumps({'args': args, 'kwargs': kwargs})
+
+        conn = self.connection()
+        deadline = time.time() + timeout
+        while True:
+            # The depth check and the insert are one transaction, so
+            # concurrent producers can't overfill the outbox.
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                depth = self.depth()
+                if depth < self.max_depth:
+                    now = time.time()
+                    cur = conn.execute(
+                        "INSERT INTO outbox"
+                        " (method, args, state, created_at, visible_at)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        (method, data, PENDING, now, now))
+                    conn.execute('COMMIT')
+                    return cur.lastrowid
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            if time.time() >= deadline:
+                raise OutboxFull(depth)
+            time.sleep(DEFAULT_POLL_INTERVAL)
+
+    def claim(self):
+        """Takes the oldest visible item, hiding it from other workers
+        for 'visibility_timeout' seconds. Returns an OutboxItem or None
+        if there is nothing to do.
+        """
+        conn = self.connection()
+        while True:
+            now = time.time()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    "SELECT id, method, args, attempts, sent FROM outbox"
+                    " WHERE state IN (?, ?) AND visible_at <= ?"
+                    " ORDER BY id LIMIT 1",
+                    (PENDING, INFLIGHT, now)).fetchone()
+                if row is None:
+                    conn.execute('COMMIT')
+                    return None
+                item_id, method, data, attempts, sent = row
+                if sent:
+                    # A worker died while waiting for Beanstream.
+                    self._finish(item_id, UNKNOWN, error="Worker timed out")
+                elif attempts >= self.max_attempts:
+                    # Workers keep dying before sending this one.
+                    self._finish(item_id, DEAD, error="Too many attempts")
+                else:
+                    conn.execute(
+                        "UPDATE outbox SET state = ?, attempts = attempts + 1,"
+                        " visible_at = ? WHERE id = ?",
+                        (INFLIGHT, now + self.visibility_timeout, item_id))
+                    conn.execute('COMMIT')
+                    attempts += 1
+                    break
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+        try:
+            data = json.loads(data)
+            return OutboxItem(item_id, method, data['args'], data['kwargs'],
+                              attempts)
+        except (ValueError, KeyError, TypeError):
+            self._finish(item_id, DEAD, error="Unreadable item")
+            return self.claim()
+
+    def mark_sent(self, item_id):
+        self.connection().execute(
+            "UPDATE outbox SET sent = 1 WHERE id = ?", (item_id,))
+
+    def _finish(self, item_id, state, result=None, error=None):
+        # Arguments are only kept while the item may be sent.
+        self.connection().execute(
+            "UPDATE outbox SET state = ?, args = '', finished_at = ?,"
+            " result = ?, error = ? WHERE id = ?",
+            (state, time.time(), result, error, item_id))
+
+    def retry_later(self, item_id, attempts, error):
+        """Puts back an item whose request didn't go through, or
+        kills it once it ran out of attempts.
+        """
+        if attempts >= self.max_attempts:
+            self._finish(item_id, DEAD, error=error)
+            return DEAD
+        delay = self.retry_delay * 2 ** (attempts - 1)
+        self.connection().execute(
+            "UPDATE outbox SET state = ?, sent = 0, visible_at = ?,"
+            " error = ? WHERE id = ?",
+            (PENDING, time.time() + delay, error, item_id))
+        return PENDING
+
+    def process(self, client, item, on_result=None):
+        """Sends a claimed item through 'client' and records the
+        outcome.
+        """
+        response = error = None
+        self.mark_sent(item.id)
+        try:
+            response = getattr(client, item.method)(*item.args, **item.kwargs)
+        except BeanUserError as e:
+            # Sending it again won't change anything.
+            error = e
+            state = DEAD
+            self._finish(item.id, DEAD, error=str(e))
+        except BeanResponseError as e:
+            # The response doesn't tell if it went through.
+            error = e
+            state = UNKNOWN
+            self._finish(item.id, UNKNOWN, error=str(e))
+        except (BeanSystemError, URLError) as e:
+            # Beanstream failed to process it, or never got it.
+            error = e
+            state = self.retry_later(item.id, item.attempts, str(e))
+        except Exception as e:
+            error = e
+            state = UNKNOWN
+            self._finish(item.id, UNKNOWN, error=repr(e))
+        else:
+            state = DONE
+            self._finish(item.id, DONE, result=json.dumps(response.data))
+
+        if on_result is not None and state != PENDING:
+            on_result(item.id, response, error)
+        return state
+
+    def get(self, item_id):
+        """Returns an item's state, result data and error."""
+        row = self.connection().execute(
+            "SELECT state, result, error FROM outbox WHERE id = ?",
+            (item_id,)).fetchone()
+        if row is None:
+            return None
+        state, result, error = row
+        return {
+            'state': state,
+            'result': json.loads(result) if result else None,
+            'error': error,
+            }
+
+    def stats(self):
+        """Returns queue depth, number of items per state, age of the
+        oldest waiting item in seconds and items finished per second
+        over the last minute.
+        """
+        conn = self.connection()
+        now = time.time()
+        counts = dict(conn.execute(
+            "SELECT state, COUNT(*) FROM outbox GROUP BY state").fetchall())
+        oldest = conn.execute(
+            "SELECT MIN(created_at) FROM outbox WHERE state IN (?, ?)",
+            (PENDING, INFLIGHT)).fetchone()[0]
+        drained = conn.execute(
+            "SELECT COUNT(*) FROM outbox WHERE finished_at >= ?",
+            (now - DRAIN_RATE_WINDOW,)).fetchone()[0]
+        stats = {
+            'depth': counts.get(PENDING, 0) + counts.get(INFLIGHT, 0),
+            'oldest_age': now - oldest if oldest is not None else 0.0,
+            'drain_rate': float(drained) / DRAIN_RATE_WINDOW,
+            }
+        for state in (PENDING, INFLIGHT, DONE, DEAD, UNKNOWN):
+            stats[state] = counts.get(state, 0)
+        return stats
+
+    def purge(self, older_than):
+        """Deletes items finished more than 'older_than' seconds ago.
+        """
+        self.connection().execute(
+            "DELETE FROM outbox WHERE finished_at < ?",
+            (time.time() - older_than,))
+
+    def _work(self, client_factory, on_result, poll_interval):
+        client = None
+        try:
+            while not self._stop.is_set():
+                try:
+                    if client is None:
+                        client = client_factory()
+                    item = self.claim()
+                    if item is None:
+                        self._stop.wait(poll_interval)
+                    else:
+                        self.process(client, item, on_result)
+                except Exception:
+                    # Items left inflight are picked up again once
+                    # their visibility timeout expires.
+                    log.exception("Outbox worker error")
+                    self._stop.wait(poll_interval)
+        finally:
+            self.close()
+
+    def start(self,
+              client_factory,
+              workers=4,
+              on_result=None,
+              poll_interval=DEFAULT_POLL_INTERVAL):
+        """Starts 'workers' threads draining the outbox. Each one gets
+        its own client from 'client_factory'. 'on_result' is called
+        with (item_id, response, error) once an item is finished.
+        """
+        self._stop.clear()
+        for i in range(workers):
+            t = threading.Thread(
+                target=self._work,
+                args=(client_factory, on_result, poll_interval))
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def stop(self):
+        """Stops the workers once their current item is done. Each one
+        closes its connection to the database as it exits; call close()
+        for the calling thread's own.
+        """
+        self._stop.set()
+        for t in self._workers:
+            t.join()
+        self._workers = []
@@ -0,0 +1,221 @@
+# retry.py
+# This file is part of PyBeanstream.
+#
+# Copyright(c) 2011 Benoit Clennett-Sirois. All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301  USA
+
+import random
+import threading
+import time
+
+from suds.transport import TransportError
+
+from pybeanstream.client import (
+    BaseBeanClientException, BeanResponseError, BeanSystemError,
+    BeanUserError, URLError,
+)
+
+try:
+    from http.client import HTTPException
+except ImportError:
+    from httplib import HTTPException
+
+# Failure phases.
+# The connection could not be opened: nothing was sent.
+CONNECT = 'connect'
+# Beanstream answered with a system error ('errorType' S): it failed
+# to process the transaction.
+SYSTEM = 'system'
+# The request was sent but no usable answer came back.
+AMBIGUOUS = 'ambiguous'
+
+# Phases after which a transaction type can be sent again. Ambiguous
+# failures are only retried once 'order_lookup' confirms nothing was
+# processed. Refunds never are: an order can have several of them, so
+# a lookup can't tell whether this one went through.
+RETRYABLE_PHASES = {
+    'P': (CONNECT, SYSTEM, AMBIGUOUS),
+    'PA': (CONNECT, SYSTEM, AMBIGUOUS),
+    'PAC': (CONNECT, SYSTEM, AMBIGUOUS),
+    'R': (CONNECT, SYSTEM),
+    'V': (CONNECT, SYSTEM, AMBIGUOUS),
+}
+
+DEFAULT_MAX_ATTEMPTS = 3
+# Backoff bounds and total time allowed for a transaction, in seconds.
+DEFAULT_BASE_DELAY = 0.2
+DEFAULT_MAX_DELAY = 5.0
+DEFAULT_TIME_BUDGET = 30.0
+
+# Each transaction earns this fraction of a retry...
+DEFAULT_RETRY_RATIO = 0.1
+# ...and the budget holds at most this many retries.
+DEFAULT_MAX_RETRY_TOKENS = 10
+
+
+def failure_phase(error):
+    """Returns the phase in which a transaction failed, or None if the
+    error is not worth retrying, eg: rejected data.
+    """
+    if isinstance(error, BeanUserError):
+        return None
+    if isinstance(error, BeanResponseError):
+        return AMBIGUOUS
+    if isinstance(error, BeanSystemError):
+        return SYSTEM
+    # HTTP errors are raised by suds as TransportError, so a URLError
+    # means the connection was never opened.
+    if isinstance(error, URLError):
+        return CONNECT
+    if isinstance(error, (EnvironmentError, HTTPException, TransportError,
+                          BaseBeanClientException)):
+        return AMBIGUOUS
+    return None
+
+
+class RetryBudget(object):
+    """Token bucket shared by the transactions of a client. Retries
+    are limited to a fraction of the traffic, so an incident doesn't
+    multiply the load on Beanstream.
+    """
+    def __init__(self,
+                 ratio=DEFAULT_RETRY_RATIO,
+                 max_tokens=DEFAULT_MAX_RETRY_TOKENS):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(max_tokens)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """Retries failed transactions with jittered exponential backoff,
+    within 'time_budget' seconds per transaction and the client's
+    RetryBudget, when the transaction type and failure phase allow it.
+
+    'order_lookup' is called with (order_num, trn_type) before retrying
+    after an ambiguous failure. It must return the BeanResponse of that
+    transaction of the order if it was processed, or None if it wasn't.
+    It is called again when a retry is rejected, since Beanstream
+    rejects a second completion or void of the same transaction.
+    Without it, ambiguous failures are never retried.
+    """
+    def __init__(self,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY,
+                 time_budget=DEFAULT_TIME_BUDGET,
+                 budget=None,
+                 retryable_phases=RETRYABLE_PHASES,
+                 order_lookup=None,
+                 sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.time_budget = time_budget
+        self.budget = budget if budget is not None else RetryBudget()
+        self.retryable_phases = retryable_phases
+        self.order_lookup = order_lookup
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.counters = {
+            'transactions': 0,
+            'attempts': 0,
+            'retries': 0,
+            'backoff_seconds': 0.0,
+            'budget_exhausted': 0,
+            'lookups': 0,
+            }
+        self.retries_by_type = {}
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        """Returns the counters, and retries for each trnType."""
+        with self.lock:
+            stats = dict(self.counters)
+            stats['retries_by_type'] = dict(self.retries_by_type)
+        return stats
+
+    def backoff(self, attempt):
+        """Full jitter: a random delay up to the exponential bound."""
+        bound = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, bound)
+
+    def lookup(self, trn_type, order_num):
+        if self.order_lookup is None:
+            return None
+        self._count('lookups')
+        return self.order_lookup(order_num, trn_type)
+
+    def run(self, trn_type, order_num, send):
+        """Calls 'send' until it returns a response or the failure
+        can't be retried, in which case the last error is raised.
+        """
+        start = time.time()
+        attempt = 0
+        ambiguous = False
+        self.budget.deposit()
+        self._count('transactions')
+        while True:
+            attempt += 1
+            self._count('attempts')
+            try:
+                return send()
+            except Exception as e:
+                phase = failure_phase(e)
+                if ambiguous and isinstance(e, BeanUserError):
+                    # An earlier attempt may have gone through, and
+                    # this one was rejected as a duplicate.
+                    found = self.lookup(trn_type, order_num)
+                    if found is not None:
+                        return found
+                if phase is None or attempt >= self.max_attempts:
+                    raise
+                if phase not in self.retryable_phases.get(trn_type, ()):
+                    raise
+                if phase == AMBIGUOUS:
+                    if self.order_lookup is None:
+                        raise
+                    ambiguous = True
+                    found = self.lookup(trn_type, order_num)
+                    if found is not None:
+                        return found
+                delay = self.backoff(attempt)
+                if time.time() - start + delay > self.time_budget:
+                    raise
+                if not self.budget.withdraw():
+                    self._count('budget_exhausted')
+                    raise
+            with self.lock:
+                self.counters['retries'] += 1
+                self.counters['backoff_seconds'] += delay
+                self.retries_by_type[trn_type] = (
+                    self.retries_by_type.get(trn_type, 0) + 1)
+            self.sleep(delay)
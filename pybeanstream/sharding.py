@@ -0,0 +1,347 @@
+# sharding.py
+# This file is part of PyBeanstream.
+#
+# Copyright(c) 2011 Benoit Clennett-Sirois. All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301  USA
+
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import pickle
+import threading
+import time
+from bisect import bisect
+# Python 2 needs the 'futures' backport, see setup.py.
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from pybeanstream.client import BaseBeanClientException
+from pybeanstream.endpoints import DEFAULT_EWMA_ALPHA
+
+log = logging.getLogger(__name__)
+
+# Points each worker gets on the ring. More points spread merchants
+# more evenly.
+DEFAULT_REPLICAS = 100
+
+# Calls each worker runs at once. They mostly wait on Beanstream.
+DEFAULT_THREADS = 8
+
+
+def ring_hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hashing ring: adding or removing a node only moves
+    the keys of that node.
+    """
+    def __init__(self, nodes=(), replicas=DEFAULT_REPLICAS):
+        self.replicas = replicas
+        self.points = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(set(self.owners))
+
+    def add(self, node):
+        for i in range(self.replicas):
+            h = ring_hash('%s:%s' % (node, i))
+            i = bisect(self.points, h)
+            self.points.insert(i, h)
+            self.owners.insert(i, node)
+
+    def remove(self, node):
+        kept = [(p, n) for p, n in zip(self.points, self.owners)
+                if n != node]
+        self.points = [p for p, n in kept]
+        self.owners = [n for p, n in kept]
+
+    def get(self, key):
+        """Returns the node owning 'key'."""
+        if not self.points:
+            raise KeyError("The ring is empty.")
+        i = bisect(self.points, ring_hash(key)) % len(self.points)
+        return self.owners[i]
+
+
+def shard_worker(conn, client_factory, threads=DEFAULT_THREADS):
+    """Worker process loop. Keeps one client per merchant of its shard
+    and answers calls with (request id, ok, result, seconds), running
+    up to 'threads' of them at once.
+    """
+    clients = {}
+    lock = threading.Lock()
+    send_lock = threading.Lock()
+
+    def send(answer):
+        with send_lock:
+            conn.send(answer)
+
+    def run(req_id, merchant_id, method, args, kwargs):
+        start = time.time()
+        try:
+            with lock:
+                client = clients.get(merchant_id)
+                if client is None:
+                    client = clients[merchant_id] = client_factory(
+                        merchant_id)
+            result = getattr(client, method)(*args, **kwargs)
+            ok = True
+        except Exception as e:
+            result = e
+            ok = False
+            try:
+                # Some exceptions pickle but can't be rebuilt.
+                pickle.loads(pickle.dumps(e))
+            except Exception:
+                result = BaseBeanClientException(repr(e))
+        try:
+            send((req_id, ok, result, time.time() - start))
+        except Exception as e:
+            # Results or errors that can't be pickled.
+            send((req_id, False, BaseBeanClientException(repr(e)),
+                  time.time() - start))
+
+    pool = ThreadPoolExecutor(threads)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        if msg[0] == 'evict':
+            with lock:
+                for merchant_id in msg[1]:
+                    clients.pop(merchant_id, None)
+            continue
+        pool.submit(run, *msg[1:])
+    pool.shutdown(wait=True)
+    conn.close()
+
+
+class Shard(object):
+    """A worker process, the calls waiting for it and its stats.
+
+    'send_lock' serializes writes to the pipe, 'lock' guards the rest.
+    The reader thread only needs 'lock', which is never held while
+    sending, so a full pipe can't block it.
+    """
+    def __init__(self, name, client_factory, threads=DEFAULT_THREADS):
+        self.name = name
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=shard_worker, args=(child_conn, client_factory, threads))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.merchants = set()
+        self.completed = 0
+        self.errors = 0
+        self.latency = None
+
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def send(self, msg):
+        with self.send_lock:
+            self.conn.send(msg)
+
+    def call(self, req_id, merchant_id, method, args, kwargs):
+        future = Future()
+        # Calls can't be cancelled once queued.
+        future.set_running_or_notify_cancel()
+        with self.lock:
+            self.pending[req_id] = (future, time.time())
+            self.merchants.add(merchant_id)
+        try:
+            self.send(('call', req_id, merchant_id, method, args, kwargs))
+        except Exception as e:
+            # Eg: arguments that can't be pickled.
+            with self.lock:
+                self.pending.pop(req_id, None)
+            future.set_exception(e)
+        return future
+
+    def owned(self):
+        """Returns the merchants this worker has clients for."""
+        with self.lock:
+            return list(self.merchants)
+
+    def evict(self, merchant_ids):
+        with self.lock:
+            self.merchants.difference_update(merchant_ids)
+        self.send(('evict', list(merchant_ids)))
+
+    def _fail_pending(self, message):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for future, start in pending.values():
+            future.set_exception(BaseBeanClientException(message))
+
+    def _read(self):
+        a = DEFAULT_EWMA_ALPHA
+        while True:
+            try:
+                req_id, ok, result, seconds = self.conn.recv()
+            except (EOFError, IOError):
+                break
+            except Exception:
+                # The request id went with the unreadable answer, so
+                # none of the waiting calls can be trusted.
+                log.exception("Unreadable answer from worker %s", self.name)
+                self._fail_pending(
+                    "Unreadable answer from worker %s" % self.name)
+                continue
+            with self.lock:
+                if req_id not in self.pending:
+                    # Already failed above.
+                    continue
+                future, start = self.pending.pop(req_id)
+                latency = time.time() - start
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency = a * latency + (1 - a) * self.latency
+                self.completed += 1
+                if not ok:
+                    self.errors += 1
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+        self._fail_pending("Worker %s died" % self.name)
+
+    def stop(self):
+        """Lets the worker finish the calls it got, then stops it."""
+        try:
+            self.send(None)
+        except (IOError, ValueError):
+            pass
+        self.process.join()
+        self.reader.join()
+        self.conn.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'merchants': len(self.merchants),
+                'inflight': len(self.pending),
+                'completed': self.completed,
+                'errors': self.errors,
+                'latency': self.latency,
+                }
+
+
+class ShardDispatcher(object):
+    """Spreads merchants over a pool of worker processes with a
+    consistent hashing ring, so each worker only keeps warm clients for
+    its own merchants.
+
+    'client_factory' is called in the workers with a merchant id and
+    returns its BeanClient. It must be picklable, eg: a module level
+    function, on platforms that don't fork. Each worker runs up to
+    'threads' calls at once, so clients are shared between threads.
+    """
+    def __init__(self,
+                 client_factory,
+                 workers=4,
+                 replicas=DEFAULT_REPLICAS,
+                 threads=DEFAULT_THREADS):
+        self.client_factory = client_factory
+        self.threads = threads
+        self.ring = HashRing(replicas=replicas)
+        self.shards = {}
+        self.lock = threading.Lock()
+        self._names = itertools.count()
+        self._ids = itertools.count()
+        for i in range(workers):
+            self.add_worker()
+
+    def _moves(self):
+        # Merchants each worker no longer owns. Needs 'lock'.
+        moves = []
+        for shard in self.shards.values():
+            moved = [m for m in shard.owned()
+                     if self.ring.get(m) != shard.name]
+            if moved:
+                moves.append((shard, moved))
+        return moves
+
+    def add_worker(self):
+        """Starts a worker and moves its share of merchants to it.
+        Returns its name.
+        """
+        with self.lock:
+            name = 'shard-%d' % next(self._names)
+        shard = Shard(name, self.client_factory, self.threads)
+        with self.lock:
+            self.shards[name] = shard
+            self.ring.add(name)
+            moves = self._moves()
+        # Workers drop the clients of merchants they no longer own.
+        # Sending may wait on a busy worker, so it's done unlocked.
+        for other, moved in moves:
+            other.evict(moved)
+        return name
+
+    def remove_worker(self, name):
+        """Stops a worker once it's done with its calls. Its merchants
+        move to the other workers.
+        """
+        with self.lock:
+            shard = self.shards.pop(name)
+            self.ring.remove(name)
+        shard.stop()
+
+    def shard_for(self, merchant_id):
+        return self.ring.get(merchant_id)
+
+    def submit(self, merchant_id, method, *args, **kwargs):
+        """Calls BeanClient.'method' for 'merchant_id' in its worker.
+        Returns a concurrent.futures.Future.
+        """
+        with self.lock:
+            shard = self.shards[self.ring.get(merchant_id)]
+            req_id = next(self._ids)
+        # Not under 'lock': a full pipe to one worker must not hold
+        # up calls to the others.
+        return shard.call(req_id, merchant_id, method, args, kwargs)
+
+    def call(self, merchant_id, method, *args, **kwargs):
+        return self.submit(merchant_id, method, *args, **kwargs).result()
+
+    def stats(self):
+        """Returns merchants, calls in flight, completed calls, errors
+        and round trip latency of each worker.
+        """
+        with self.lock:
+            shards = list(self.shards.values())
+        return dict((s.name, s.stats()) for s in shards)
+
+    def close(self):
+        with self.lock:
+            shards, self.shards = list(self.shards.values()), {}
+            self.ring = HashRing(replicas=self.ring.replicas)
+        for shard in shards:
+            shard.stop()
@@ -20,18 +20,45 @@
 # MA 02110-1301  USA
 
 
+import gc
 import os
+import random
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
 import unittest
 import json
+from datetime import date
+from decimal import Decimal
 
-from mock import Mock
+from mock import Mock, patch
 
+from pybeanstream import benchmark, forking
 from pybeanstream.client import (
     BeanClient, BeanUserError, BeanResponse,
-    BeanSystemError, BaseBeanClientException,
+    BeanSystemError, BeanResponseError, BaseBeanClientException, URLError,
+    PRELOADED_CLIENTS, preload,
 )
+from pybeanstream.batch import BatchResults, amount_to_cents
+from pybeanstream.bins import BinIndex, CardBrand, default_index
+from pybeanstream.endpoints import EndpointPool
+from pybeanstream.ledger import Ledger, parse_trn_date
+from pybeanstream.outbox import Outbox, OutboxFull
+from pybeanstream.retry import RetryBudget, RetryPolicy
+from pybeanstream.sharding import HashRing, ShardDispatcher
+from pybeanstream.transports import NameValueTransport
 from pybeanstream.xml_utils import xmltodict
 
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from urlparse import parse_qs
+
 
 # Read errors from external file because very long.
 
@@ -40,6 +67,27 @@ EXPECTED_RSP = json.loads(
         os.path.dirname(__file__), 'test_results.json')).read())
 
 
+def make_list(cc_num, cvv, exp_m, exp_y, amount, order_num):
+    # Returns a prepared list with test data already filled in.
+    d = ('Jérémy Noël',
+         cc_num,
+         cvv,
+         exp_m,
+         exp_y,
+         amount,
+         order_num,
+         'john.doe@pranana.com',
+         'Jérémy Noël',
+         '5145555555',
+         '88 Mont-Royal Est',
+         'Montreal',
+         'QC',
+         'H2T1N6',
+         'CA',
+         )
+    return d
+
+
 class TestComponents(unittest.TestCase):
     def setUp(self):
         self.b = BeanClient(
@@ -75,6 +123,10 @@ class TestComponents(unittest.TestCase):
         self.assertRaises(BeanSystemError,
                           self.b.check_for_errors,
                           r)
+        r = BeanResponse({'trnId': '1'}, 'P')
+        self.assertRaises(BeanResponseError,
+                          self.b.check_for_errors,
+                          r)
         r = BeanResponse({'errorType': 'N',
                           'trnApproved': '1',
                           'messageText': 'bad'},
@@ -82,30 +134,1177 @@ class TestComponents(unittest.TestCase):
         self.assertEqual(self.b.check_for_errors(r), None)
 
 
+class TestBatchResults(unittest.TestCase):
+    def setUp(self):
+        self.results = BatchResults()
+        for k in sorted(EXPECTED_RSP):
+            self.results.append(BeanResponse(xmltodict(EXPECTED_RSP[k]), 'P'))
+
+    def test_aggregations(self):
+        r = self.results
+        self.assertEqual(len(r), len(EXPECTED_RSP))
+        approved = r.where(trnApproved=True)
+        self.assertEqual(r.count(approved), 11)
+        self.assertEqual(r.count_by('cardType'),
+                         {'VI': 10, 'AM': 3, 'MC': 2})
+        self.assertEqual(r.approval_rate(by='cardType'),
+                         {'VI': 0.8, 'AM': 2 / 3.0, 'MC': 0.5})
+        visa = r.where(cardType='VI', trnType='P')
+        self.assertEqual(r.count(visa), 4)
+        self.assertEqual(str(r.total_amount(visa)), '131.00')
+        self.assertEqual(r.total_amount(r.where(visa, trnApproved=True)),
+                         Decimal('20.00'))
+        self.assertEqual(len(r.where(cardType='XX')), 0)
+
+    def test_save_load(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'batch.bin')
+            self.results.save(path)
+            loaded = BatchResults.load(path)
+        finally:
+            shutil.rmtree(d)
+        self.assertEqual(len(loaded), len(self.results))
+        self.assertEqual(loaded.count_by('avsId'),
+                         self.results.count_by('avsId'))
+        self.assertEqual(list(loaded.column('trnId')),
+                         list(self.results.column('trnId')))
+        self.assertEqual(loaded.total_amount(), self.results.total_amount())
+
+    def test_to_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest("NumPy is not installed.")
+        arrays = self.results.to_numpy()
+        self.assertEqual(int(arrays['trnAmount'].sum()),
+                         int(self.results.total_amount() * 100))
+        codes, categories = arrays['cardType']
+        self.assertEqual(int((codes == categories.index('AM')).sum()), 3)
+
+    def test_where_without_numpy(self):
+        r = self.results
+        expected = [list(r.where(cardType='VI', trnApproved=True)),
+                    list(r.where(r.where(trnType='P'), trnAmount='10.00'))]
+        with patch('pybeanstream.batch.numpy', None):
+            self.assertEqual(
+                [list(r.where(cardType='VI', trnApproved=True)),
+                 list(r.where(r.where(trnType='P'), trnAmount='10.00'))],
+                expected)
+        self.assertTrue(len(expected[0]) > 0)
+
+    def test_amount_to_cents(self):
+        self.assertEqual(amount_to_cents('10.5'), 1050)
+        self.assertEqual(amount_to_cents('-1.50'), -150)
+        self.assertEqual(amount_to_cents('-0.05'), -5)
+        self.assertEqual(amount_to_cents('.99'), 99)
+        self.assertEqual(amount_to_cents(''), 0)
+
+
+class TestBinIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = default_index()
+
+    def test_lookup(self):
+        i = self.index
+        self.assertEqual(i.brand('4030000010001234'), 'VI')
+        self.assertEqual(i.brand('4504481742333'), 'VI')
+        self.assertEqual(i.brand('371100001000131'), 'AM')
+        self.assertEqual(i.brand('5100000010001004'), 'MC')
+        self.assertEqual(i.brand('2221000000000009'), 'MC')
+        self.assertEqual(i.brand('6011000990139424'), 'NN')
+        self.assertEqual(i.brand(b'3530111333300000'), 'JB')
+        self.assertEqual(i.brand('9999999999999999'), None)
+        self.assertEqual(i.brand(''), None)
+        self.assertEqual(i.lookup('378282246310005').cvd_length, 4)
+        self.assertEqual(
+            [b.brand for b in i.lookup_many(
+                ['4030000010001234', '342400001000180'])],
+            ['VI', 'AM'])
+
+    def test_narrowest_range_wins(self):
+        visa = CardBrand('VI', (16,), 3)
+        debit = CardBrand('PV', (16,), 3)
+        index = BinIndex([('4', '4', visa), ('4506', '4506', debit)])
+        self.assertEqual(index.brand('4505000000000000'), 'VI')
+        self.assertEqual(index.brand('4506000000000000'), 'PV')
+        self.assertEqual(index.brand('4507000000000000'), 'VI')
+        self.assertEqual(len(index), 3)
+
+    def test_overlapping_ranges(self):
+        # Checked against the narrowest covering range found by hand.
+        rnd = random.Random(42)
+        ranges = []
+        for i in range(300):
+            low = rnd.randint(0, 99999)
+            high = min(low + rnd.choice([0, 10, 100, 1000, 20000]), 99999)
+            ranges.append(('%05d' % low, '%05d' % high,
+                           CardBrand('B%d' % i, (16,), 3)))
+        index = BinIndex(ranges)
+        spans = [(int(l) * 1000, int(h) * 1000 + 999, b)
+                 for l, h, b in ranges]
+        for i in range(2000):
+            key = rnd.randint(0, 99999999)
+            covering = [s for s in spans if s[0] <= key <= s[1]]
+            expected = (min(covering, key=lambda s: s[1] - s[0])[2]
+                        if covering else None)
+            self.assertTrue(index.lookup('%08d' % key) is expected)
+
+    def test_large_index(self):
+        start = time.time()
+        index = BinIndex(('%06d' % i, '%06d' % i, CardBrand('VI', (16,), 3))
+                         for i in range(0, 200000, 2))
+        self.assertEqual(len(index), 100000)
+        self.assertTrue(time.time() - start < 10)
+
+    def test_validate(self):
+        i = self.index
+        self.assertEqual(i.validate('371100001000131', '1234').brand, 'AM')
+        self.assertRaises(BeanUserError, i.validate,
+                          '371100001000131', '123')
+        self.assertRaises(BeanUserError, i.validate, '40300000100012')
+        self.assertRaises(BeanUserError, i.validate, '9999999999999999')
+        try:
+            i.validate('5100000010001004', supported=['VI', 'AM'])
+        except BeanUserError as e:
+            self.assertEqual(e.fields, ['trnCardNumber'])
+        else:
+            self.fail("MasterCard should not be supported.")
+
+    def test_route(self):
+        routes = {'VI': 'visa_account', 'AM': 'amex_account'}
+        self.assertEqual(
+            self.index.route('371100001000131', routes), 'amex_account')
+        self.assertEqual(
+            self.index.route('5100000010001004', routes, 'other'), 'other')
+
+
+class FakeClient(object):
+    """Answers refunds from EXPECTED_RSP, or raises 'error'."""
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    def refund_request(self, amount, order_num, adj_id):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return BeanResponse(xmltodict(EXPECTED_RSP['test_refund']), 'R')
+
+
+class ShardClient(FakeClient):
+    """Tells which process and merchant answered."""
+    def __init__(self, merchant_id):
+        super(ShardClient, self).__init__()
+        self.merchant_id = merchant_id
+
+    def refund_request(self, amount, order_num, adj_id):
+        if adj_id == 'bad':
+            raise BeanUserError('adjId', 'Invalid adjustment id')
+        r = super(ShardClient, self).refund_request(amount, order_num, adj_id)
+        r.data['merchant_id'] = self.merchant_id
+        r.data['pid'] = os.getpid()
+        return r
+
+    def echo(self, payload):
+        return payload
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return os.getpid()
+
+    def unreadable(self):
+        return Unreadable()
+
+
+def unpickle_unreadable():
+    raise ValueError("Can't be unpickled")
+
+
+class Unreadable(object):
+    def __reduce__(self):
+        return unpickle_unreadable, ()
+
+
+def shard_client(merchant_id):
+    return ShardClient(merchant_id)
+
+
+class TestSharding(unittest.TestCase):
+    def test_hash_ring(self):
+        ring = HashRing(['a', 'b', 'c'])
+        keys = ['merchant-%d' % i for i in range(1000)]
+        before = dict((k, ring.get(k)) for k in keys)
+        self.assertEqual(set(before.values()), set(['a', 'b', 'c']))
+
+        ring.remove('b')
+        after = dict((k, ring.get(k)) for k in keys)
+        for k in keys:
+            if before[k] != 'b':
+                self.assertEqual(before[k], after[k])
+
+        ring.add('b')
+        self.assertEqual(before, dict((k, ring.get(k)) for k in keys))
+        self.assertRaises(KeyError, HashRing().get, 'merchant-1')
+
+    def test_dispatch(self):
+        d = ShardDispatcher(shard_client, workers=3)
+        try:
+            merchants = ['merchant-%d' % i for i in range(30)]
+            futures = [(m, d.submit(m, 'refund_request',
+                                    '0.01', '567121', '10000787'))
+                       for m in merchants * 2]
+            pids = {}
+            for m, f in futures:
+                data = f.result(10).data
+                self.assertEqual(data['merchant_id'], m)
+                # A merchant is always served by the same worker.
+                self.assertEqual(pids.setdefault(m, data['pid']),
+                                 data['pid'])
+            self.assertEqual(len(set(pids.values())), 3)
+
+            stats = d.stats()
+            self.assertEqual(
+                sum(s['completed'] for s in stats.values()), 60)
+            self.assertEqual(
+                sum(s['merchants'] for s in stats.values()), 30)
+            self.assertEqual(
+                sum(s['inflight'] for s in stats.values()), 0)
+
+            self.assertRaises(BeanUserError, d.call, merchants[0],
+                              'refund_request', '0.01', '567121', 'bad')
+
+            # A new worker only takes merchants from the others.
+            name = d.add_worker()
+            moved = [m for m in merchants if d.shard_for(m) == name]
+            self.assertTrue(moved)
+            self.assertEqual(
+                sum(s['merchants'] for s in d.stats().values()),
+                30 - len(moved))
+            d.remove_worker(name)
+            self.assertEqual(len(d.stats()), 3)
+            data = d.call(moved[0], 'refund_request',
+                          '0.01', '567121', '10000787').data
+            self.assertEqual(data['pid'], pids[moved[0]])
+        finally:
+            d.close()
+
+    def test_large_messages(self):
+        # Calls and answers bigger than the pipe's buffer, both ways.
+        d = ShardDispatcher(shard_client, workers=1)
+        try:
+            payload = 'x' * 1000000
+            futures = [d.submit('merchant-1', 'echo', payload)
+                       for i in range(10)]
+            for f in futures:
+                self.assertEqual(len(f.result(30)), len(payload))
+        finally:
+            d.close()
+
+    def test_concurrent_calls(self):
+        # A worker runs calls for its merchants at the same time.
+        d = ShardDispatcher(shard_client, workers=1, threads=3)
+        try:
+            start = time.time()
+            futures = [d.submit('merchant-%d' % (i % 2), 'sleep', 1)
+                       for i in range(3)]
+            pids = [f.result(10) for f in futures]
+            self.assertTrue(time.time() - start < 2)
+            self.assertEqual(len(set(pids)), 1)
+            self.assertEqual(d.stats()['shard-0']['completed'], 3)
+        finally:
+            d.close()
+
+    def test_busy_worker(self):
+        # A worker that stopped reading its pipe doesn't hold up calls
+        # to the others, nor the dispatcher's own methods.
+        if not hasattr(signal, 'SIGSTOP'):
+            raise unittest.SkipTest("Needs SIGSTOP")
+        d = ShardDispatcher(shard_client, workers=2)
+        try:
+            merchants = ['merchant-%d' % i for i in range(30)]
+            busy, idle = sorted(d.shards)
+            busy_merchant = [m for m in merchants
+                             if d.shard_for(m) == busy][0]
+            idle_merchant = [m for m in merchants
+                             if d.shard_for(m) == idle][0]
+            pid = d.shards[busy].process.pid
+            results = []
+
+            def use_idle():
+                results.append(d.call(idle_merchant, 'echo', 'a'))
+                d.stats()
+                d.remove_worker(d.add_worker())
+                results.append('done')
+            os.kill(pid, signal.SIGSTOP)
+            try:
+                busy_thread = threading.Thread(
+                    target=d.submit,
+                    args=(busy_merchant, 'echo', 'x' * 1000000))
+                busy_thread.daemon = True
+                busy_thread.start()
+                # Let the send fill the pipe.
+                time.sleep(0.2)
+                idle_thread = threading.Thread(target=use_idle)
+                idle_thread.daemon = True
+                idle_thread.start()
+                idle_thread.join(5)
+            finally:
+                os.kill(pid, signal.SIGCONT)
+            self.assertEqual(results, ['a', 'done'])
+            busy_thread.join(10)
+            self.assertFalse(busy_thread.is_alive())
+        finally:
+            d.close()
+
+    def test_unreadable_answer(self):
+        d = ShardDispatcher(shard_client, workers=1)
+        try:
+            f = d.submit('merchant-1', 'unreadable')
+            self.assertRaises(BaseBeanClientException, f.result, 10)
+            # The worker keeps serving.
+            self.assertEqual(d.call('merchant-1', 'echo', 'a'), 'a')
+        finally:
+            d.close()
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'outbox.db')
+        self.outboxes = []
+
+    def tearDown(self):
+        for outbox in self.outboxes:
+            outbox.close()
+        shutil.rmtree(self.dir)
+
+    def make_outbox(self, **kw):
+        outbox = Outbox(self.path, **kw)
+        self.outboxes.append(outbox)
+        return outbox
+
+    def test_drain(self):
+        outbox = self.make_outbox()
+        ids = [outbox.enqueue('refund_request', '0.01', '567121',
+                              '10000787') for i in range(20)]
+        self.assertEqual(outbox.stats()['depth'], 20)
+
+        results = []
+        done = threading.Event()
+
+        def on_result(item_id, response, error):
+            results.append((item_id, response.data['trnId'], error))
+            if len(results) == len(ids):
+                done.set()
+
+        outbox.start(FakeClient, workers=3, on_result=on_result,
+                     poll_interval=0.01)
+        try:
+            self.assertTrue(done.wait(10))
+        finally:
+            outbox.stop()
+
+        self.assertEqual(sorted(r[0] for r in results), ids)
+        stats = outbox.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['done'], 20)
+        self.assertEqual(stats['oldest_age'], 0.0)
+        self.assertTrue(stats['drain_rate'] > 0)
+        self.assertEqual(outbox.get(ids[0])['result']['trnId'], '10000800')
+
+    def test_crash_recovery(self):
+        outbox = self.make_outbox(visibility_timeout=0)
+        sent = outbox.enqueue('refund_request', '0.01', '1', '10000787')
+        unsent = outbox.enqueue('refund_request', '0.01', '2', '10000787')
+
+        # Two workers claim an item each and die, one after sending.
+        outbox.mark_sent(outbox.claim().id)
+        outbox.claim()
+
+        # The sent item is not submitted again, the other one is.
+        item = outbox.claim()
+        self.assertEqual(item.id, unsent)
+        self.assertEqual(item.attempts, 2)
+        self.assertEqual(outbox.get(sent)['state'], 'unknown')
+
+    def test_retries_and_poison(self):
+        outbox = self.make_outbox(max_attempts=2, retry_delay=0)
+        system = outbox.enqueue('refund_request', '0.01', '1', '10000787')
+        client = FakeClient(BeanSystemError('down'))
+        self.assertEqual(outbox.process(client, outbox.claim()), 'pending')
+        self.assertEqual(outbox.process(client, outbox.claim()), 'dead')
+        self.assertEqual(client.calls, 2)
+
+        user = outbox.enqueue('refund_request', '0.01', '1', '10000787')
+        client = FakeClient(BeanUserError('adjId', 'Invalid'))
+        self.assertEqual(outbox.process(client, outbox.claim()), 'dead')
+        self.assertEqual(outbox.claim(), None)
+        self.assertEqual(outbox.stats()['dead'], 2)
+        self.assertTrue('down' in outbox.get(system)['error'])
+        self.assertTrue('adjId' in outbox.get(user)['error'])
+
+        # A response without an error type may have gone through.
+        unclear = outbox.enqueue('refund_request', '0.01', '1', '10000787')
+        client = FakeClient(BeanResponseError('None'))
+        self.assertEqual(outbox.process(client, outbox.claim()), 'unknown')
+        self.assertEqual(outbox.claim(), None)
+        self.assertEqual(client.calls, 1)
+
+        # Arguments are dropped once items are finished.
+        conn = outbox.connection()
+        self.assertEqual(
+            conn.execute("SELECT DISTINCT args FROM outbox").fetchall(),
+            [('',)])
+
+    def test_card_data_refused(self):
+        outbox = self.make_outbox()
+        card = make_list('4030000010001234', '123', '05', '15', '10.00',
+                         '138889')
+        self.assertRaises(ValueError, outbox.enqueue,
+                          'purchase_request', *card)
+        token = make_list('', '', '05', '15', '10.00', '138889')
+        self.assertRaises(ValueError, outbox.enqueue,
+                          'preauth_request', *token, cc_num='4030000010001234',
+                          single_use_token='a-token')
+        outbox.enqueue('purchase_request', *token,
+                       single_use_token='a-token')
+        self.assertEqual(outbox.depth(), 1)
+
+    def test_worker_survives_errors(self):
+        outbox = self.make_outbox()
+        ids = [outbox.enqueue('refund_request', '0.01', '567121',
+                              '10000787') for i in range(2)]
+        done = threading.Event()
+        results = []
+
+        def on_result(item_id, response, error):
+            results.append(item_id)
+            if len(results) == 1:
+                raise RuntimeError('bad callback')
+            done.set()
+
+        outbox.start(FakeClient, workers=1, on_result=on_result,
+                     poll_interval=0.01)
+        try:
+            self.assertTrue(done.wait(10))
+        finally:
+            outbox.stop()
+        self.assertEqual(results, ids)
+
+    def test_stop_closes_connections(self):
+        outbox = self.make_outbox()
+        outbox.enqueue('refund_request', '0.01', '1', '10000787')
+        outbox.start(FakeClient, workers=2, poll_interval=0.01)
+        for i in range(500):
+            if outbox.stats()['done']:
+                break
+            threading.Event().wait(0.01)
+        outbox.stop()
+        outbox.close()
+        # SQLite removes the WAL files once the last connection is
+        # closed, so the workers let go of theirs.
+        self.assertFalse(os.path.exists(self.path + '-wal'))
+        self.assertFalse(os.path.exists(self.path + '-shm'))
+
+    def test_backpressure(self):
+        outbox = self.make_outbox(max_depth=1)
+        outbox.enqueue('refund_request', '0.01', '1', '10000787')
+        self.assertRaises(OutboxFull, outbox.enqueue,
+                          'refund_request', '0.01', '2', '10000787')
+        self.assertRaises(ValueError, outbox.enqueue, 'process_transaction')
+
+
+class WsdlHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'<definitions/>')
+
+    def log_message(self, *a):
+        pass
+
+
+def closed_port_url():
+    # Returns an url nobody listens on.
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return 'http://127.0.0.1:%d/ProcessTransaction.asmx?WSDL' % port
+
+
+class TestEndpoints(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), WsdlHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.up_url = 'http://127.0.0.1:%d/ProcessTransaction.asmx?WSDL' % (
+            self.server.server_address[1])
+        self.down_url = closed_port_url()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_probe_marks_unreachable_endpoint(self):
+        pool = EndpointPool([self.down_url, self.up_url])
+        # Nothing measured yet: configured order wins.
+        self.assertEqual(pool.best().url, self.down_url)
+        pool.probe(timeout=2)
+        pool.probe(timeout=2)
+        self.assertEqual(pool.best().url, self.up_url)
+        stats = dict((s['url'], s) for s in pool.stats())
+        self.assertFalse(stats[self.down_url]['healthy'])
+        self.assertEqual(stats[self.down_url]['errors'], 2)
+        self.assertTrue(stats[self.up_url]['healthy'])
+        self.assertTrue(stats[self.up_url]['latency'] > 0)
+        # Failures are not timed.
+        self.assertTrue(stats[self.down_url]['latency'] is None)
+
+    def test_errors_decay(self):
+        pool = EndpointPool([self.up_url, self.down_url], error_half_life=30)
+        primary, backup = pool.endpoints
+        primary.record_success(0.1)
+        backup.record_success(0.2)
+        primary.record_failure()
+        primary.record_failure()
+        self.assertFalse(primary.healthy)
+        self.assertTrue(pool.best() is backup)
+        for i in range(1000):
+            backup.record_success(0.2)
+        self.assertTrue(pool.best() is backup)
+
+        # A minute later, the blip is forgotten.
+        primary._updated_at -= 60
+        self.assertTrue(primary.healthy)
+        self.assertTrue(pool.best() is primary)
+
+    def test_background_probes(self):
+        pool = EndpointPool([self.down_url, self.up_url])
+        pool.start_probes(interval=0.01, timeout=2)
+        try:
+            for i in range(500):
+                if not pool.endpoints[0].healthy:
+                    break
+                threading.Event().wait(0.01)
+        finally:
+            pool.stop_probes()
+        self.assertEqual(pool.best().url, self.up_url)
+
+    @patch('pybeanstream.client.clone_client')
+    @patch('pybeanstream.client.Client')
+    def test_failover(self, client, clone_client):
+        b = BeanClient('a_username', 'a_password', 'a_merchant_id',
+                       wsdl_url=[self.down_url, self.up_url])
+        clones = []
+
+        def clone(client):
+            c = Mock()
+            c.set_options.side_effect = (
+                lambda **kw: c.service.TransactionProcess.configure_mock(
+                    side_effect=process(kw['location'])))
+            clones.append(c)
+            return c
+
+        def process(location):
+            def send(req):
+                if location == self.down_url.split('?')[0]:
+                    raise URLError('Connection refused')
+                return EXPECTED_RSP['test_refund']
+            return send
+        clone_client.side_effect = clone
+
+        result = b.refund_request('0.01', '567121', '10000787')
+        self.assertTrue(result.data['trnApproved'])
+        stats = b.endpoint_stats()
+        self.assertEqual(stats[0]['errors'], 1)
+        self.assertEqual(stats[1]['requests'], 1)
+
+        # Calls now go straight to the healthy endpoint.
+        b.refund_request('0.01', '567121', '10000787')
+        self.assertEqual(b.endpoint_stats()[1]['requests'], 2)
+        self.assertEqual(b.endpoint_stats()[0]['requests'], 1)
+        # One client per endpoint; the shared one is never redirected.
+        self.assertEqual(len(clones), 2)
+        self.assertFalse(b.suds_client.service.TransactionProcess.called)
+        for call in b.suds_client.set_options.call_args_list:
+            self.assertFalse('location' in call[1])
+
+    @patch('pybeanstream.client.clone_client')
+    @patch('pybeanstream.client.Client')
+    def test_all_endpoints_down(self, client, clone_client):
+        b = BeanClient('a_username', 'a_password', 'a_merchant_id',
+                       wsdl_url=[self.down_url, self.up_url])
+        clone = clone_client.return_value
+        clone.service.TransactionProcess.side_effect = URLError(
+            'Connection refused')
+        self.assertRaises(URLError, b.refund_request,
+                          '0.01', '567121', '10000787')
+        self.assertEqual(
+            [s['errors'] for s in b.endpoint_stats()], [1, 1])
+
+    def test_failover_with_suds(self):
+        # Per endpoint clients through the real suds client.
+        server = benchmark.BeanstreamServer()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            b = BeanClient('a_username', 'a_password', 'a_merchant_id',
+                           wsdl_url=[closed_port_url(),
+                                     server.url(benchmark.SOAP_PATH +
+                                                '?WSDL')])
+            r = b.process_transaction('TransactionProcess',
+                                      benchmark.TRANSACTION)
+            self.assertEqual(r['trnApproved'], ['1'])
+            self.assertTrue(b.suds_client.options.location is None)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class NameValueHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    requests = []
+
+    def setup(self):
+        NameValueHandler.connections += 1
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        NameValueHandler.requests.append(parse_qs(body.decode('ascii')))
+        content = (
+            'trnApproved=1&trnId=10000800&messageId=1&messageText=Approved'
+            '&trnOrderNumber=138889&errorType=N&errorFields=&trnAmount=10.00'
+            '&avsProcessed=0&avsAddrMatch=0&avsPostalMatch=0&cardType=VI'
+            '&trnType=P').encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *a):
+        pass
+
+
+class TestNameValueTransport(unittest.TestCase):
+    def setUp(self):
+        NameValueHandler.connections = 0
+        NameValueHandler.requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), NameValueHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.transport = NameValueTransport(
+            'http://127.0.0.1:%d/scripts/process_transaction.asp' % (
+                self.server.server_address[1]))
+        self.b = BeanClient('a_username', 'a_password', 'a_merchant_id',
+                            transport=self.transport)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_purchase(self):
+        self.assertEqual(self.b.suds_client, None)
+        data = list(make_list('4030000010001234', '123', '05', '15',
+                              '10.00', '138889'))
+        # Too long, will be cut to 2 characters.
+        data[12] = 'Quebec'
+        for i in range(2):
+            result = self.b.purchase_request(*data)
+            self.assertTrue(result.data['trnApproved'])
+            self.assertFalse(result.data['avsProcessed'])
+            self.assertEqual(result.data['errorFields'], '')
+            self.assertEqual(result.data['trnOrderNumber'], '138889')
+
+        # Both requests went through the same connection.
+        self.assertEqual(NameValueHandler.connections, 1)
+        req = NameValueHandler.requests[0]
+        self.assertEqual(req['requestType'], ['BACKEND'])
+        self.assertEqual(req['merchant_id'], ['a_merchan'])
+        self.assertEqual(req['trnCardOwner'], ['Jeremy Noel'])
+        self.assertEqual(req['ordProvince'], ['Qu'])
+        self.assertFalse('serviceVersion' in req)
+
+    def test_concurrent_posts(self):
+        server = benchmark.BeanstreamServer()
+        server.delay = 0.2
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        transport = NameValueTransport(
+            server.url(benchmark.NAME_VALUE_PATH), max_idle=2)
+        b = BeanClient('a_username', 'a_password', 'a_merchant_id',
+                       transport=transport)
+        results = []
+
+        def refund():
+            results.append(b.refund_request('0.01', '567121', '10000787'))
+        threads = [threading.Thread(target=refund) for i in range(4)]
+        try:
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - start
+        finally:
+            transport.close()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(len(results), 4)
+        # One at a time would take 0.8 seconds.
+        self.assertTrue(elapsed < 0.6, elapsed)
+        self.assertEqual(server.reset()['connections'], 4)
+
+    def test_idle_connections(self):
+        self.transport.max_idle = 1
+        self.transport.connect()
+        self.transport.connect()
+        self.assertEqual(len(self.transport._idle), 1)
+        conn = self.transport._idle[0][0]
+        self.b.refund_request('0.01', '567121', '10000787')
+        self.assertTrue(self.transport._idle[0][0] is conn)
+
+        # Stale connections are replaced.
+        self.transport._idle[0] = (conn, 0)
+        self.b.refund_request('0.01', '567121', '10000787')
+        self.assertEqual(len(self.transport._idle), 1)
+        self.assertFalse(self.transport._idle[0][0] is conn)
+
+    def test_connection_refused(self):
+        self.transport.host = closed_port_url().split('/')[2]
+        self.assertRaises(URLError, self.b.refund_request,
+                          '0.01', '567121', '10000787')
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run(self):
+        # Both APIs through a local server and the real suds client.
+        results = benchmark.run(calls=8, threads=4, delay=0.01)
+        soap, name_value = results['soap'], results['name_value']
+        self.assertEqual(soap['calls'], 8)
+        self.assertEqual(name_value['calls'], 8)
+        self.assertEqual(name_value['connections'], 1)
+        self.assertTrue(
+            name_value['request_bytes'] < soap['request_bytes'])
+        concurrent = results['name_value_concurrent']
+        self.assertEqual(concurrent['calls'], 8)
+        self.assertTrue(1 <= concurrent['connections'] <= 4)
+
+
+def private_kb():
+    # Unique set size: pages this process doesn't share with any other.
+    total = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                total += int(line.split()[1])
+    return total
+
+
+class TestPreload(unittest.TestCase):
+    def tearDown(self):
+        PRELOADED_CLIENTS.clear()
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+    def in_child(self, test):
+        """Runs 'test' in a forked child and returns its exit status.
+        """
+        if not hasattr(os, 'fork'):
+            raise unittest.SkipTest("Needs os.fork")
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                if not hasattr(os, 'register_at_fork'):
+                    forking.after_fork()
+                code = 0 if test() else 2
+            finally:
+                os._exit(code)
+        return os.waitpid(pid, 0)[1]
+
+    @patch('pybeanstream.client.clone_client')
+    @patch('pybeanstream.client.Client')
+    def test_workers_share_preloaded_wsdl(self, client, clone_client):
+        preload(freeze=False)
+        self.assertEqual(client.call_count, 1)
+
+        def child():
+            b = BeanClient('a_username', 'a_password', 'a_merchant_id')
+            # The WSDL was not loaded again, only cloned.
+            return (client.call_count == 1 and
+                    b.suds_client is clone_client.return_value)
+        self.assertEqual(self.in_child(child), 0)
+
+    def fork_workers(self, url, n):
+        """Forks 'n' workers one after the other, each building a client
+        for 'url' and sending one transaction. Returns their private
+        memory in kB and the seconds they took.
+        """
+        results = []
+        for i in range(n):
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    if not hasattr(os, 'register_at_fork'):
+                        forking.after_fork()
+                    start = time.time()
+                    b = BeanClient('a_username', 'a_password',
+                                   'a_merchant_id', wsdl_url=url)
+                    b.process_transaction('TransactionProcess',
+                                          benchmark.TRANSACTION)
+                    elapsed = time.time() - start
+                    os.write(w, json.dumps(
+                        [private_kb(), elapsed]).encode('ascii'))
+                    code = 0
+                finally:
+                    os._exit(code)
+            os.close(w)
+            with os.fdopen(r, 'rb') as f:
+                data = f.read()
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            results.append(json.loads(data.decode('ascii')))
+        return results
+
+    def test_preloaded_workers(self):
+        # Workers forked after preload() use less memory of their own
+        # and answer their first transaction faster. Needs the real
+        # suds client.
+        if not hasattr(os, 'fork'):
+            raise unittest.SkipTest("Needs os.fork")
+        if not os.path.exists('/proc/self/smaps_rollup'):
+            raise unittest.SkipTest("Needs /proc/self/smaps_rollup")
+        server = benchmark.BeanstreamServer()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = server.url(benchmark.SOAP_PATH + '?WSDL')
+        try:
+            cold = self.fork_workers(url, 5)
+            preload(url)
+            warm = self.fork_workers(url, 5)
+        finally:
+            server.shutdown()
+            server.server_close()
+        for i in (0, 1):
+            # Compares medians: memory in kB, then seconds.
+            self.assertTrue(sorted(w[i] for w in warm)[2] <
+                            sorted(c[i] for c in cold)[2], (cold, warm))
+
+    def test_after_fork_resets_connections(self):
+        NameValueHandler.connections = 0
+        server = HTTPServer(('127.0.0.1', 0), NameValueHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        transport = NameValueTransport(
+            'http://127.0.0.1:%d/' % server.server_address[1])
+        b = BeanClient('a_username', 'a_password', 'a_merchant_id',
+                       transport=transport)
+        pool = EndpointPool([closed_port_url()])
+        pool.start_probes(interval=60)
+        try:
+            b.warm_up()
+            self.assertEqual(len(transport._idle), 1)
+
+            def child():
+                return (transport._idle == [] and
+                        pool._probe_thread.is_alive())
+            self.assertEqual(self.in_child(child), 0)
+            # The parent's connection is still usable.
+            self.assertTrue(b.refund_request(
+                '0.01', '567121', '10000787').data['trnApproved'])
+            self.assertEqual(NameValueHandler.connections, 1)
+        finally:
+            pool.stop_probes()
+            transport.close()
+            server.shutdown()
+            server.server_close()
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.policy = RetryPolicy(sleep=self.sleeps.append)
+        self.b = BeanClient('a_username', 'a_password', 'a_merchant_id',
+                            retry_policy=self.policy)
+        self.b.suds_client = Mock()
+        self.process = self.b.suds_client.service.TransactionProcess
+
+    def purchase(self):
+        return self.b.purchase_request(
+            *make_list('4030000010001234', '123', '05', '15', '10.00',
+                       '138889'))
+
+    def test_retry_transient_failures(self):
+        self.process.side_effect = [
+            URLError('Connection refused'),
+            EXPECTED_RSP['test_purchase_transaction_visa_approve']]
+        self.assertTrue(self.purchase().data['trnApproved'])
+
+        stats = self.policy.stats()
+        self.assertEqual(stats['attempts'], 2)
+        self.assertEqual(stats['retries_by_type'], {'P': 1})
+        self.assertEqual(stats['backoff_seconds'], sum(self.sleeps))
+        self.assertTrue(0 <= self.sleeps[0] <= self.policy.base_delay)
+
+    def test_user_errors_are_not_retried(self):
+        self.process.side_effect = BeanUserError('trnCardNumber', 'Invalid')
+        self.assertRaises(BeanUserError, self.purchase)
+        self.assertEqual(self.process.call_count, 1)
+
+    def test_max_attempts(self):
+        self.process.side_effect = BeanSystemError('down')
+        self.assertRaises(BeanSystemError, self.purchase)
+        self.assertEqual(self.process.call_count, 3)
+        self.assertEqual(self.policy.stats()['retries'], 2)
+
+    def test_ambiguous_failures(self):
+        # Without a lookup, nothing is sent again after a timeout...
+        self.process.side_effect = socket.timeout('timed out')
+        self.assertRaises(socket.timeout, self.b.void_request,
+                          '10.00', '243364', '10000770')
+        self.assertRaises(socket.timeout, self.purchase)
+        self.assertEqual(self.process.call_count, 2)
+
+        # ...nor after a response without an error type...
+        self.process.reset_mock()
+        self.process.side_effect = None
+        self.process.return_value = '<response><trnId>1</trnId></response>'
+        self.assertRaises(BeanResponseError, self.purchase)
+        self.assertEqual(self.process.call_count, 1)
+
+        # ...and refunds can't be looked up.
+        self.policy.order_lookup = lambda order_num, trn_type: None
+        self.process.reset_mock()
+        self.process.side_effect = socket.timeout('timed out')
+        self.assertRaises(socket.timeout, self.b.refund_request,
+                          '0.01', '567121', '10000787')
+        self.assertEqual(self.process.call_count, 1)
+
+    def test_duplicate_after_ambiguous_failure(self):
+        # The first void went through but its answer was lost, so the
+        # second one is rejected.
+        voided = BeanResponse(xmltodict(EXPECTED_RSP['test_voids']), 'V')
+        lookups = []
+
+        def lookup(order_num, trn_type):
+            lookups.append((order_num, trn_type))
+            return voided if len(lookups) > 1 else None
+
+        self.policy.order_lookup = lookup
+        self.process.side_effect = [
+            socket.timeout('timed out'),
+            '<response><errorType>U</errorType><errorFields>adjId'
+            '</errorFields><messageText>Already voided</messageText>'
+            '</response>']
+        self.assertTrue(self.b.void_request(
+            '10.00', '243364', '10000770') is voided)
+        self.assertEqual(lookups, [('243364', 'V'), ('243364', 'V')])
+
+    def test_order_lookup(self):
+        processed = BeanResponse(
+            xmltodict(EXPECTED_RSP['test_purchase_transaction_visa_approve']),
+            'P')
+        lookups = []
+
+        def lookup(order_num, trn_type):
+            lookups.append((order_num, trn_type))
+            return processed if len(lookups) > 1 else None
+
+        self.policy.order_lookup = lookup
+        self.process.side_effect = socket.timeout('timed out')
+        self.assertTrue(self.purchase() is processed)
+        # Sent again after the first lookup, found after the second.
+        self.assertEqual(lookups, [('138889', 'P'), ('138889', 'P')])
+        self.assertEqual(self.process.call_count, 2)
+
+    def test_retry_budget(self):
+        # The transaction only earns a single retry.
+        self.policy.budget = RetryBudget(ratio=1, max_tokens=1)
+        self.policy.budget.tokens = 0
+        self.process.side_effect = BeanSystemError('down')
+        self.assertRaises(BeanSystemError, self.purchase)
+        self.assertEqual(self.process.call_count, 2)
+        self.assertEqual(self.policy.stats()['budget_exhausted'], 1)
+
+    def test_time_budget(self):
+        self.policy.time_budget = 0
+        self.process.side_effect = BeanSystemError('down')
+        self.assertRaises(BeanSystemError, self.purchase)
+        self.assertEqual(self.process.call_count, 1)
+
+
+def make_response(trn_id, order_num, trn_type, amount,
+                  trn_date='3/17/2014 6:37:50 PM', approved='1'):
+    return BeanResponse({
+        'trnId': [trn_id],
+        'trnOrderNumber': [order_num],
+        'trnType': [trn_type],
+        'trnAmount': [amount],
+        'trnDate': [trn_date],
+        'trnApproved': [approved],
+        'errorType': ['N'],
+        }, trn_type)
+
+
+class TestLedger(unittest.TestCase):
+    def setUp(self):
+        self.ledger = Ledger(':memory:')
+        self.ledger.record(make_response('100', 'order-1', 'P', '10.00'))
+        self.ledger.record(make_response(
+            '101', 'order-2', 'P', '5.00', approved='0'))
+        self.ledger.record(make_response('102', 'order-2', 'P', '5.00'))
+        self.ledger.record(make_response(
+            '103', 'order-3', 'PA', '20.00', '3/18/2014 9:00:00 AM'))
+        self.ledger.record(make_response(
+            '104', 'order-3', 'PAC', '15.00', '3/18/2014 9:05:00 AM'),
+            adj_id='103')
+
+    def tearDown(self):
+        self.ledger.close()
+
+    def test_indexes(self):
+        self.assertEqual(self.ledger.get('100')['amount'], 1000)
+        self.assertEqual(self.ledger.get('999'), None)
+        self.assertEqual(
+            [r['trn_id'] for r in self.ledger.by_order('order-2')],
+            [101, 102])
+        self.assertEqual(
+            [r['trn_id'] for r in self.ledger.between(
+                date(2014, 3, 18), date(2014, 3, 19))],
+            [103, 104])
+        self.assertEqual(self.ledger.original('order-2')['trn_id'], 102)
+        self.assertEqual(self.ledger.original('order-3')['trn_id'], 104)
+        self.assertRaises(BeanUserError, self.ledger.original, 'order-4')
+
+    def test_refundable_balance(self):
+        self.assertEqual(self.ledger.refundable(100), 1000)
+        self.ledger.record(make_response('105', 'order-1', 'R', '4.00'),
+                           adj_id='100')
+        self.ledger.record(make_response(
+            '106', 'order-1', 'R', '4.00', approved='0'), adj_id='100')
+        self.assertEqual(self.ledger.refundable(100), 600)
+        self.ledger.check_refund(100, '6.00')
+        self.assertRaises(BeanUserError, self.ledger.check_refund,
+                          100, '6.01')
+        self.assertEqual(self.ledger.refundable(101), 0)
+
+    def test_void_eligibility(self):
+        self.ledger.check_void(100, today=date(2014, 3, 17))
+        self.assertRaises(BeanUserError, self.ledger.check_void,
+                          100, today=date(2014, 3, 18))
+        self.assertRaises(BeanUserError, self.ledger.check_void,
+                          101, today=date(2014, 3, 17))
+        self.ledger.record(make_response('105', 'order-1', 'VP', '10.00'),
+                           adj_id='100')
+        self.assertEqual(self.ledger.refundable(100), 0)
+        self.assertRaises(BeanUserError, self.ledger.check_void,
+                          100, today=date(2014, 3, 17))
+
+    def test_client_adjustments_by_order(self):
+        b = BeanClient('a_username', 'a_password', 'a_merchant_id',
+                       ledger=self.ledger)
+        b.suds_client = Mock()
+        process = b.suds_client.service.TransactionProcess
+        process.return_value = EXPECTED_RSP[
+            'test_purchase_transaction_visa_approve']
+        b.purchase_request(
+            *make_list('4030000010001234', '123', '05', '15', '10.00',
+                       '138889'))
+        self.assertEqual(self.ledger.original('138889')['trn_id'], 10000679)
+
+        process.return_value = EXPECTED_RSP['test_refund']
+        b.refund_by_order('4.00', '138889')
+        self.assertTrue('<adjId>10000679</adjId>' in process.call_args[0][0])
+        # The refund was recorded against the purchase.
+        self.assertEqual(
+            [r['trn_id'] for r in self.ledger.adjustments(10000679)],
+            [10000800])
+
+        process.reset_mock()
+        self.assertRaises(BeanUserError, b.refund_by_order,
+                          '10.00', '138889')
+        self.assertRaises(BeanUserError, b.void_by_order, '138889')
+        self.assertEqual(process.call_count, 0)
+
+    def test_trn_dates(self):
+        self.assertEqual(parse_trn_date('3/17/2014 6:37:50 PM'),
+                         '2014-03-17 18:37:50')
+        self.assertEqual(parse_trn_date('3/17/2014 12:05:00 AM'),
+                         '2014-03-17 00:05:00')
+        self.assertEqual(parse_trn_date('12/1/2014 12:05:00 pm'),
+                         '2014-12-01 12:05:00')
+        self.assertEqual(parse_trn_date('3/17/2014 18:37:50'),
+                         '2014-03-17 18:37:50')
+        for value in (None, '', 'soon', '2/30/2014 1:00:00 PM',
+                      '3/17/2014 13:00:00 PM'):
+            self.assertEqual(parse_trn_date(value), None)
+        # Unparsable dates are stored as NULL.
+        self.ledger.record(make_response('105', 'order-5', 'P', '1.00',
+                                         trn_date='17 mars 2014'))
+        self.assertEqual(self.ledger.get('105')['trn_date'], None)
+
+    def test_recording_is_best_effort(self):
+        b = BeanClient('a_username', 'a_password', 'a_merchant_id',
+                       ledger=self.ledger)
+        b.suds_client = Mock()
+        b.suds_client.service.TransactionProcess.return_value = (
+            EXPECTED_RSP['test_refund'])
+        with patch.object(self.ledger, 'record',
+                          side_effect=ValueError('bad trnDate')):
+            r = b.refund_request('0.01', '567121', '10000787')
+        self.assertTrue(r.data['trnApproved'])
+
+    def test_concurrent_refunds(self):
+        b = BeanClient('a_username', 'a_password', 'a_merchant_id',
+                       ledger=self.ledger)
+        b.suds_client = Mock()
+
+        def process(req):
+            threading.Event().wait(0.1)
+            return ('<response><trnApproved>1</trnApproved>'
+                    '<trnId>105</trnId><trnOrderNumber>order-1'
+                    '</trnOrderNumber><trnType>R</trnType>'
+                    '<trnAmount>10.00</trnAmount><errorType>N</errorType>'
+                    '</response>')
+        b.suds_client.service.TransactionProcess.side_effect = process
+
+        errors = []
+
+        def refund():
+            try:
+                b.refund_by_order('10.00', 'order-1')
+            except BeanUserError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=refund) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # The second refund saw the first one in the ledger.
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(
+            b.suds_client.service.TransactionProcess.call_count, 1)
+
+
 class TestApiTransactions(unittest.TestCase):
     def setUp(self):
         self.b = BeanClient('a_username', 'a_password', 'a_merchant_id')
         self.b.suds_client = Mock()
 
     def make_list(self, cc_num, cvv, exp_m, exp_y, amount, order_num):
-        # Returns a prepared list with test data already filled in.
-        d = ('Jérémy Noël',
-             cc_num,
-             cvv,
-             exp_m,
-             exp_y,
-             amount,
-             order_num,
-             'john.doe@pranana.com',
-             'Jérémy Noël',
-             '5145555555',
-             '88 Mont-Royal Est',
-             'Montreal',
-             'QC',
-             'H2T1N6',
-             'CA',
-             )
-        return d
+        return make_list(cc_num, cvv, exp_m, exp_y, amount, order_num)
 
     def test_pre_auth(self):
         """
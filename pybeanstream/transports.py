@@ -0,0 +1,171 @@
+# transports.py
+# This file is part of PyBeanstream.
+#
+# Copyright(c) 2011 Benoit Clennett-Sirois. All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301  USA
+
+import socket
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import urlencode, urlparse, parse_qs
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection
+    from urllib import urlencode
+    from urlparse import urlparse, parse_qs
+
+from pybeanstream import forking
+from pybeanstream.client import BaseBeanClientException, URLError
+
+
+NAME_VALUE_URL = 'https://www.beanstream.com/scripts/process_transaction.asp'
+
+# Fields named differently by the name/value API.
+NAME_VALUE_FIELDS = {
+    'termURL': 'termUrl',
+}
+
+# SOAP only fields.
+NAME_VALUE_SKIPPED_FIELDS = ['serviceVersion']
+
+NAME_VALUE_HEADERS = {
+    'Content-Type': 'application/x-www-form-urlencoded',
+}
+
+# Seconds to wait for Beanstream.
+DEFAULT_TIMEOUT = 60
+
+# Seconds after which an unused connection is assumed to have been
+# dropped by the server, and is reopened before sending.
+DEFAULT_IDLE_TIMEOUT = 30
+
+# Connections kept open between transactions. Threads sending at the
+# same time open more, which are closed afterwards.
+DEFAULT_MAX_IDLE = 4
+
+
+class NameValueTransport(object):
+    """Sends transactions as URL encoded name/value posts instead of
+    SOAP. Requests are much smaller than the SOAP envelope with its
+    embedded XML document, and the query string response parses to
+    the same dictionary of lists as xmltodict.
+
+    HTTP connections are kept alive between transactions, up to
+    'max_idle' of them. Each transaction takes one from the pool for
+    its round trip, so threads sharing the transport send at the same
+    time.
+    """
+    def __init__(self,
+                 url=NAME_VALUE_URL,
+                 timeout=DEFAULT_TIMEOUT,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_idle=DEFAULT_MAX_IDLE):
+        parts = urlparse(url)
+        self.url = url
+        self.secure = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.path = parts.path
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        # (connection, last used) pairs, the most recent last.
+        self._idle = []
+        forking.register(self)
+
+    def after_fork(self):
+        # The sockets are shared with the parent: leave them to the
+        # parent and let the next post open new ones.
+        self.lock = threading.Lock()
+        self._idle = []
+
+    def encode(self, items):
+        """Returns the request body for (field, text) pairs."""
+        fields = [('requestType', 'BACKEND')]
+        for k, val in items:
+            if k not in NAME_VALUE_SKIPPED_FIELDS:
+                fields.append((NAME_VALUE_FIELDS.get(k, k), val))
+        return urlencode(fields)
+
+    def decode(self, body):
+        return parse_qs(body, keep_blank_values=True)
+
+    def _open(self):
+        # Failures are raised as URLError since nothing was sent yet.
+        if self.secure:
+            conn = HTTPSConnection(self.host, timeout=self.timeout)
+        else:
+            conn = HTTPConnection(self.host, timeout=self.timeout)
+        try:
+            conn.connect()
+        except (socket.error, socket.timeout) as e:
+            raise URLError(e)
+        return conn
+
+    def connect(self):
+        """Opens a connection ahead of the first transaction and puts
+        it in the pool.
+        """
+        self._release(self._open())
+
+    def _acquire(self):
+        now = time.time()
+        with self.lock:
+            if self._idle and now - self._idle[-1][1] <= self.idle_timeout:
+                return self._idle.pop()[0]
+            # Older ones have been idle even longer.
+            stale, self._idle = self._idle, []
+        for conn, last_used in stale:
+            conn.close()
+        return self._open()
+
+    def _release(self, conn):
+        with self.lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def close(self):
+        """Closes the idle connections."""
+        with self.lock:
+            idle, self._idle = self._idle, []
+        for conn, last_used in idle:
+            conn.close()
+
+    def post(self, body):
+        conn = self._acquire()
+        try:
+            conn.request('POST', self.path, body, NAME_VALUE_HEADERS)
+            resp = conn.getresponse()
+            content = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn)
+        if resp.status != 200:
+            raise BaseBeanClientException(
+                "Unexpected HTTP status: %s %s" % (resp.status, resp.reason))
+        return content.decode('utf-8')
+
+    def process(self, items):
+        """Sends (field, text) pairs and returns the response as a
+        dictionary of lists.
+        """
+        return self.decode(self.post(self.encode(items)))
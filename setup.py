@@ -33,6 +33,7 @@ setup(name='PyBeanstream',
       author='Benoit C. Sirois',
       author_email='bclennett@caravan.coop',
       packages=find_packages(),
+      package_data={'pybeanstream': ['bin_ranges.csv']},
       namespace_packages=['pybeanstream',], 
       classifiers = [
         'Programming Language :: Python',
@@ -40,7 +41,8 @@ setup(name='PyBeanstream',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: GNU Library or Lesser General Public License (LGPL)',
         ],
-      install_requires=['suds-jurko==0.6',],
+      install_requires=['suds-jurko==0.6',
+                        'futures; python_version < "3.2"'],
       setup_requires=['nose'],
       tests_require=['nose', 'coverage', 'mock'],
       url='https://repos.caravan.coop/open-source/pybeanstream',